@@ -0,0 +1,6 @@
+"""
+Offline benchmarks for the downloader: a synthetic public.bybit.com mirror, a local server with
+injectable latency, errors and throttling, and a runner that reports throughput and resource use.
+
+Run with: python -m benchmarks.run --help
+"""
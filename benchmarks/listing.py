@@ -0,0 +1,114 @@
+"""
+Listing parser and startup benchmark.
+
+Times bybit_history.listing.parse_listing (the single-pass parser) against the BeautifulSoup
+fallback on an nginx autoindex page with --files entries, as served by benchmarks.server, and
+measures how long starting the downloader takes: importing it, running `--version`, and the
+import cost of the modules it loads only on demand.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import date, timedelta
+
+from bybit_history.listing import parse_html_page, parse_listing
+
+from .server import format_listing
+
+# Modules the downloader does not import at startup; their import time is what startup saves
+DEFERRED_MODULES = ['bs4']
+
+def make_listing(files, symbol='BTCUSDT'):
+    """Renders an nginx autoindex page listing files daily trade archives."""
+    first_day = date(2020, 1, 1)
+    with tempfile.TemporaryDirectory(prefix='bybit-bench-listing-') as root:
+        for day in range(files):
+            name = f"{symbol}{(first_day + timedelta(days=day)).isoformat()}.csv.gz"
+            with open(os.path.join(root, name), 'wb') as f:
+                f.truncate(20000 + day)
+        return format_listing(f'/trading/{symbol}/', root).decode('utf-8')
+
+def time_parser(parser, page, repeat):
+    """Returns the best of repeat timings of parser(page), in seconds."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parser(page)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def time_command(command, repeat):
+    """Returns the median wall time of running command repeat times, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+def get_loaded_modules(module):
+    """Returns which of DEFERRED_MODULES are loaded after importing module in a fresh interpreter."""
+    code = f"import sys, json, {module}; print(json.dumps([name for name in {DEFERRED_MODULES!r} if name in sys.modules]))"
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the directory listing parser and downloader startup.')
+    parser.add_argument('--files', type=int, default=2000, help='Entries in the benchmark listing (default: 2000)')
+    parser.add_argument('--repeat', type=int, default=10, help='Repetitions per measurement (default: 10)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    page = make_listing(args.files)
+    if parse_listing(page) != parse_html_page(page):
+        logging.error("The fast parser and the BeautifulSoup parser disagree on the benchmark listing.")
+        sys.exit(1)
+    fast = time_parser(parse_listing, page, args.repeat)
+    fallback = time_parser(parse_html_page, page, args.repeat)
+
+    python = [sys.executable]
+    baseline = time_command(python + ['-c', 'pass'], args.repeat)
+    startup_import = time_command(python + ['-c', 'import bybit_history.bybit_data_downloader'], args.repeat)
+    startup_version = time_command(python + ['-m', 'bybit_history.bybit_data_downloader', '--version'], args.repeat)
+    deferred = {module: time_command(python + ['-c', f'import {module}'], args.repeat) - baseline for module in DEFERRED_MODULES}
+
+    results = {
+        'listing_files': args.files,
+        'listing_bytes': len(page),
+        'parse_fast_seconds': fast,
+        'parse_fallback_seconds': fallback,
+        'interpreter_seconds': baseline,
+        'import_downloader_seconds': startup_import - baseline,
+        'version_command_seconds': startup_version,
+        'deferred_import_seconds': deferred,
+        'deferred_modules_loaded_at_startup': get_loaded_modules('bybit_history.bybit_data_downloader'),
+    }
+
+    print(f"\nListing parse ({args.files} entries, {len(page) / 1e3:.0f} KB, best of {args.repeat}):")
+    print(f"  single pass:    {fast * 1e3:8.2f} ms")
+    print(f"  BeautifulSoup:  {fallback * 1e3:8.2f} ms  ({fallback / fast if fast else 0:.0f}x slower)")
+    print(f"\nStartup (median of {args.repeat}, interpreter alone {baseline * 1e3:.0f} ms):")
+    print(f"  import downloader:  {results['import_downloader_seconds'] * 1e3:6.0f} ms")
+    print(f"  start --version:    {startup_version * 1e3:6.0f} ms (total)")
+    for module, seconds in deferred.items():
+        loaded = 'loaded at startup' if module in results['deferred_modules_loaded_at_startup'] else 'not loaded at startup'
+        print(f"  import {module}:{' ' * (12 - len(module))}{seconds * 1e3:6.0f} ms ({loaded})")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
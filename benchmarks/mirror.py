@@ -0,0 +1,136 @@
+"""
+Generates a synthetic copy of the public.bybit.com layouts (see example_of_api.md) on disk.
+
+    trading/<SYMBOL>/<SYMBOL><YYYY-MM-DD>.csv.gz
+    spot/<SYMBOL>/<SYMBOL>-<YYYY-MM>.csv.gz
+    kline_for_metatrader4/<SYMBOL>/<YYYY>/<SYMBOL>_15_<YYYY-MM-DD>_<YYYY-MM-DD>.csv.gz
+    premium_index/<SYMBOL>/<SYMBOL><YYYY-MM-DD>_premium_index.csv.gz
+    spot_index/<SYMBOL>/<SYMBOL><YYYY-MM-DD>_index_price.csv.gz
+
+File contents follow the real column layouts, with random prices and sizes.
+"""
+
+import os
+import gzip
+import random
+import calendar
+from datetime import date, datetime, timedelta, timezone
+
+MIRROR_DATA_TYPES = ['trading', 'spot', 'kline_for_metatrader4', 'premium_index', 'spot_index']
+
+# Fixed modification time of generated files, so listings are identical between generations
+MIRROR_MTIME = datetime(2024, 6, 1, tzinfo=timezone.utc).timestamp()
+
+def day_start(day):
+    """Epoch seconds of midnight UTC of day."""
+    return calendar.timegm(day.timetuple())
+
+def trading_rows(rng, symbol, day, rows):
+    yield 'timestamp,symbol,side,size,price,tickDirection,trdMatchID,grossValue,homeNotional,foreignNotional\n'
+    start = day_start(day)
+    price = 40000.0
+    for i in range(rows):
+        timestamp = start + 86400 * i / rows
+        price = max(1.0, price + rng.uniform(-5, 5))
+        size = round(rng.uniform(0.001, 2), 3)
+        side = rng.choice(('Buy', 'Sell'))
+        notional = size * price
+        yield (f"{timestamp:.4f},{symbol},{side},{size},{price:.1f},PlusTick,{rng.getrandbits(64):016x},"
+               f"{int(notional * 1e8)},{size},{notional:.4f}\n")
+
+def spot_rows(rng, symbol, month_start, month_end, rows):
+    yield 'id,timestamp,price,volume,side\n'
+    start = day_start(month_start) * 1000
+    span = (day_start(month_end) + 86400) * 1000 - start
+    price = 40000.0
+    for i in range(rows):
+        price = max(1.0, price + rng.uniform(-5, 5))
+        yield f"{i + 1},{start + span * i // rows},{price:.2f},{rng.uniform(0.0001, 2):.6f},{rng.choice(('buy', 'sell'))}\n"
+
+def kline_rows(rng, month_start, month_end):
+    # Headerless MetaTrader export with 15 minute bars
+    price = 40000.0
+    day = month_start
+    while day <= month_end:
+        for minute in range(0, 1440, 15):
+            high = price + rng.uniform(0, 20)
+            low = price - rng.uniform(0, 20)
+            close = rng.uniform(low, high)
+            yield (f"{day.strftime('%Y.%m.%d')},{minute // 60:02d}:{minute % 60:02d},"
+                   f"{price:.1f},{high:.1f},{low:.1f},{close:.1f},{rng.uniform(1, 100):.3f}\n")
+            price = close
+        day += timedelta(days=1)
+
+def index_rows(rng, symbol, day):
+    # One minute bars, as in premium_index and spot_index
+    yield 'start_at,symbol,period,open,high,low,close\n'
+    start = day_start(day)
+    price = 40000.0
+    for minute in range(1440):
+        high = price + rng.uniform(0, 5)
+        low = price - rng.uniform(0, 5)
+        close = rng.uniform(low, high)
+        yield f"{start + minute * 60},{symbol},1,{price:.2f},{high:.2f},{low:.2f},{close:.2f}\n"
+        price = close
+
+def write_gzip(path, lines, compresslevel):
+    """Writes lines to path as a gzip file and returns its size."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.GzipFile(path, 'wb', compresslevel=compresslevel, mtime=0) as f:
+        f.write(''.join(lines).encode('utf-8'))
+    os.utime(path, (MIRROR_MTIME, MIRROR_MTIME))
+    return os.path.getsize(path)
+
+def iter_months(start_date, end_date):
+    """Yields (first_day, last_day) of every month overlapping [start_date, end_date]."""
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        last = month.replace(day=calendar.monthrange(month.year, month.month)[1])
+        yield month, last
+        month = last + timedelta(days=1)
+
+def generate_mirror(root, symbols, start_date, days, rows=10000, data_types=None, compresslevel=6, seed=0):
+    """Generates the mirror under root and returns {'files': count, 'bytes': compressed size}.
+
+    rows is the number of trades per trading file and per spot (monthly) file; kline and index
+    files have their natural number of bars. Files that already exist are kept, so generating a
+    larger mirror over a smaller one only adds files.
+    """
+    rng = random.Random(seed)
+    data_types = data_types or MIRROR_DATA_TYPES
+    if isinstance(start_date, str):
+        start_date = date.fromisoformat(start_date)
+    end_date = start_date + timedelta(days=days - 1)
+    dates = [start_date + timedelta(days=offset) for offset in range(days)]
+    files = 0
+    total_bytes = 0
+
+    def add(path, lines):
+        nonlocal files, total_bytes
+        path = os.path.join(root, path)
+        if not os.path.exists(path):
+            write_gzip(path, lines, compresslevel)
+        files += 1
+        total_bytes += os.path.getsize(path)
+
+    for symbol in symbols:
+        for data_type in data_types:
+            if data_type == 'trading':
+                for day in dates:
+                    add(f"trading/{symbol}/{symbol}{day.isoformat()}.csv.gz", trading_rows(rng, symbol, day, rows))
+            elif data_type == 'spot':
+                for first, last in iter_months(start_date, end_date):
+                    add(f"spot/{symbol}/{symbol}-{first.strftime('%Y-%m')}.csv.gz", spot_rows(rng, symbol, first, last, rows))
+            elif data_type == 'kline_for_metatrader4':
+                for first, last in iter_months(start_date, end_date):
+                    name = f"{symbol}_15_{first.isoformat()}_{last.isoformat()}.csv.gz"
+                    add(f"kline_for_metatrader4/{symbol}/{first.year}/{name}", kline_rows(rng, first, last))
+            elif data_type == 'premium_index':
+                for day in dates:
+                    add(f"premium_index/{symbol}/{symbol}{day.isoformat()}_premium_index.csv.gz", index_rows(rng, symbol, day))
+            elif data_type == 'spot_index':
+                for day in dates:
+                    add(f"spot_index/{symbol}/{symbol}{day.isoformat()}_index_price.csv.gz", index_rows(rng, symbol, day))
+            else:
+                raise ValueError(f"Unknown data type '{data_type}'. Use one of {MIRROR_DATA_TYPES}")
+    return {'files': files, 'bytes': total_bytes}
@@ -0,0 +1,167 @@
+"""
+Benchmark runner: generates a mirror, serves it locally and times the downloader against it.
+
+Each stage runs the downloader in a child process with --base-url pointing at the local server:
+
+    cold  - empty output directory, everything is downloaded
+    warm  - same command again, every file already exists
+    sync  - same command with --sync, unchanged directories are skipped
+
+For every stage it reports wall time, files/s, MB/s (compressed bytes served), listing request
+count and latency, injected faults, peak RSS and CPU time of the downloader process. The JSON
+output also holds the downloader's own per-stage metrics (see bybit_history/metrics.py).
+Requires a Unix-like OS (per-process resource usage comes from os.wait4).
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import date, timedelta
+
+from .mirror import MIRROR_DATA_TYPES, generate_mirror
+from .server import add_fault_arguments, get_fault_config, start_server
+
+STAGES = ['cold', 'warm', 'sync']
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values (0 if empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_downloader(command, log_path):
+    """Runs the downloader and returns (exit_code, wall_seconds, cpu_seconds, peak_rss_mb)."""
+    started = time.perf_counter()
+    with open(log_path, 'a', encoding='utf-8') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - started
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return process.returncode, wall, usage.ru_utime + usage.ru_stime, rss_mb
+
+def summarize_stage(name, records, exit_code, wall, cpu, rss_mb):
+    """Combines the server's request records with the downloader's resource usage."""
+    listings = [seconds for kind, _, status, seconds, _ in records if kind == 'listing' and status in (200, 304)]
+    files = [sent for kind, _, status, _, sent in records if kind == 'file' and status in (200, 206) and sent]
+    served = sum(sent for _, _, _, _, sent in records)
+    return {
+        'stage': name,
+        'exit_code': exit_code,
+        'wall_s': round(wall, 3),
+        'requests': len(records),
+        'files': len(files),
+        'files_per_s': round(len(files) / wall, 2) if wall else 0.0,
+        'mb': round(served / 1e6, 3),
+        'mb_per_s': round(served / 1e6 / wall, 3) if wall else 0.0,
+        'listings': len(listings),
+        'listing_mean_ms': round(1000 * sum(listings) / len(listings), 2) if listings else 0.0,
+        'listing_p95_ms': round(1000 * percentile(listings, 0.95), 2),
+        'faults': sum(1 for _, _, status, _, _ in records if status in (429, 500, 503)),
+        'cpu_s': round(cpu, 3),
+        'cpu_pct': round(100 * cpu / wall, 1) if wall else 0.0,
+        'peak_rss_mb': round(rss_mb, 1),
+    }
+
+def print_report(results):
+    columns = ['stage', 'exit_code', 'wall_s', 'files', 'files_per_s', 'mb', 'mb_per_s', 'listings',
+               'listing_mean_ms', 'listing_p95_ms', 'faults', 'cpu_s', 'cpu_pct', 'peak_rss_mb']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).rjust(width) for column, width in zip(columns, widths)))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the downloader against a local synthetic mirror')
+    parser.add_argument('--symbols', default='BTCUSDT,ETHUSDT', help='Comma-separated symbols in the mirror (default: BTCUSDT,ETHUSDT)')
+    parser.add_argument('--data-types', default='trading', help=f"Comma-separated data types in the mirror and downloaded, or 'ALL' (default: trading). Known types: {', '.join(MIRROR_DATA_TYPES)}")
+    parser.add_argument('--start-date', default='2024-01-01', help='First day of the mirror (default: 2024-01-01)')
+    parser.add_argument('--days', type=int, default=5, help='Number of days in the mirror (default: 5)')
+    parser.add_argument('--rows', type=int, default=20000, help='Trades per trading file and per monthly spot file (default: 20000)')
+    parser.add_argument('--compress-level', type=int, default=6, help='gzip level of the mirror files (default: 6)')
+    parser.add_argument('--mirror-dir', help='Directory for the mirror, reused between runs (default: a temporary directory)')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"Comma-separated stages to run (default: {','.join(STAGES)})")
+    parser.add_argument('--workers', type=int, default=1, help='Value passed to the downloader --workers (default: 1)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the output directory and downloader log')
+    add_fault_arguments(parser)
+    parser.add_argument('downloader_args', nargs=argparse.REMAINDER, help='Extra downloader arguments after --, e.g. -- --output-format parquet')
+    args = parser.parse_args()
+    if args.downloader_args[:1] == ['--']:
+        args.downloader_args = args.downloader_args[1:]
+    return args
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    symbols = [symbol.strip().upper() for symbol in args.symbols.split(',')]
+    data_types = MIRROR_DATA_TYPES if args.data_types.upper() == 'ALL' else [dt.strip().lower() for dt in args.data_types.split(',')]
+    stages = [stage.strip() for stage in args.stages.split(',')]
+    for stage in stages:
+        if stage not in STAGES:
+            logging.error(f"Unknown stage '{stage}'. Use one of {STAGES}.")
+            sys.exit(1)
+
+    work_dir = tempfile.mkdtemp(prefix='bybit-bench-')
+    mirror_dir = args.mirror_dir or os.path.join(work_dir, 'mirror')
+    output_dir = os.path.join(work_dir, 'data')
+    log_path = os.path.join(work_dir, 'downloader.log')
+
+    started = time.perf_counter()
+    mirror = generate_mirror(mirror_dir, symbols, args.start_date, args.days, args.rows, data_types, args.compress_level, args.seed)
+    logging.info(f"Mirror: {mirror['files']} files, {mirror['bytes'] / 1e6:.1f} MB in {mirror_dir} ({time.perf_counter() - started:.1f}s)")
+
+    server = start_server(mirror_dir, faults=get_fault_config(args))
+    end_date = date.fromisoformat(args.start_date) + timedelta(days=args.days - 1)
+    command = [
+        sys.executable, '-m', 'bybit_history.bybit_data_downloader',
+        '--base-url', server.base_url, '--output-dir', output_dir,
+        '--start-date', args.start_date, '--end-date', end_date.isoformat(),
+        '--coins', ','.join(symbols), '--data-types', ','.join(data_types),
+        '--workers', str(args.workers), *args.downloader_args,
+    ]
+    logging.info(f"Downloader: {' '.join(command)}")
+
+    results = []
+    try:
+        for stage in stages:
+            if stage == 'cold':
+                shutil.rmtree(output_dir, ignore_errors=True)
+            server.stats.reset()
+            metrics_path = os.path.join(work_dir, f"metrics-{stage}.json")
+            stage_command = command + ['--metrics-file', metrics_path, '--metrics-interval', '0']
+            if stage == 'sync':
+                stage_command.append('--sync')
+            exit_code, wall, cpu, rss_mb = run_downloader(stage_command, log_path)
+            result = summarize_stage(stage, server.stats.reset(), exit_code, wall, cpu, rss_mb)
+            results.append(result)
+            if os.path.exists(metrics_path):
+                # The downloader's own per-stage timings (listing, download, decompress, write)
+                with open(metrics_path, 'r', encoding='utf-8') as f:
+                    result['downloader_metrics'] = json.load(f)
+            if exit_code != 0:
+                logging.warning(f"Stage '{stage}' exited with code {exit_code}, see {log_path}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'mirror': mirror, 'command': command, 'results': results}, f, indent=2)
+    if args.keep or any(result['exit_code'] != 0 for result in results):
+        logging.info(f"Output and downloader log kept in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Local HTTP server for a mirror directory, imitating public.bybit.com (nginx autoindex).
+
+Directory URLs return nginx-style listing pages (with an ETag, honoring If-None-Match), files are
+served with Range/If-Range support, and faults can be injected: fixed latency, random 500/503 errors,
+429 throttling with Retry-After, a per-connection bandwidth cap and truncated responses.
+Every request is recorded, so benchmarks can report listing latency and bytes served.
+"""
+
+import os
+import sys
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+
+# Size of the pieces files are sent in (and the granularity of the bandwidth cap)
+SEND_CHUNK_SIZE = 64 * 1024
+
+class FaultConfig:
+    """Faults injected by the server. Rates are probabilities per request (0 disables them)."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, bandwidth=0, truncate_rate=0.0, seed=0):
+        self.latency = latency # Seconds added before every response
+        self.error_rate = error_rate # Share of requests answered with 500 or 503
+        self.throttle_rate = throttle_rate # Share of requests answered with 429
+        self.retry_after = retry_after # Retry-After seconds sent with 429/503
+        self.bandwidth = bandwidth # Bytes per second per response (0 = unlimited)
+        self.truncate_rate = truncate_rate # Share of file responses cut off halfway
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+class RequestStats:
+    """Thread-safe record of served requests: (kind, path, status, seconds, body bytes)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def add(self, kind, path, status, seconds, sent):
+        with self.lock:
+            self.records.append((kind, path, status, seconds, sent))
+
+    def reset(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+def format_listing(url_path, root_path):
+    """Renders a directory like nginx's autoindex module."""
+    lines = [
+        '<html>',
+        f'<head><title>Index of {url_path}</title></head>',
+        '<body>',
+        f'<h1>Index of {url_path}</h1><hr><pre><a href="../">../</a>',
+    ]
+    entries = sorted(os.scandir(root_path), key=lambda entry: (not entry.is_dir(), entry.name))
+    for entry in entries:
+        name = entry.name + ('/' if entry.is_dir() else '')
+        stat = entry.stat()
+        modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc).strftime('%d-%b-%Y %H:%M')
+        size = '-' if entry.is_dir() else str(stat.st_size)
+        shown = name if len(name) <= 50 else name[:47] + '..>'
+        lines.append(f'<a href="{quote(name)}">{shown}</a>{" " * (51 - len(shown))}{modified} {size:>19}')
+    lines.append('</pre><hr></body>')
+    lines.append('</html>')
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """Serves server.root; faults come from server.faults and every request is added to server.stats."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'nginx'
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        started = time.perf_counter()
+        url_path = unquote(urlsplit(self.path).path)
+        local_path = os.path.normpath(os.path.join(self.server.root, url_path.lstrip('/')))
+        kind = 'listing' if os.path.isdir(local_path) else 'file'
+        status, sent = 500, 0
+        try:
+            faults = self.server.faults
+            if faults.latency:
+                time.sleep(faults.latency)
+            if os.path.commonpath([local_path, self.server.root]) != self.server.root or not os.path.exists(local_path):
+                status = self.send_empty(404)
+            elif faults.roll(faults.throttle_rate):
+                status = self.send_empty(429, {'Retry-After': str(faults.retry_after)})
+            elif faults.roll(faults.error_rate):
+                status = self.send_empty(503, {'Retry-After': str(faults.retry_after)}) if faults.roll(0.5) else self.send_empty(500)
+            elif kind == 'listing':
+                status, sent = self.send_listing(url_path, local_path, send_body)
+            else:
+                status, sent = self.send_file(local_path, send_body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.server.stats.add(kind, url_path, status, time.perf_counter() - started, sent)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return status
+
+    def send_listing(self, url_path, local_path, send_body):
+        if not url_path.endswith('/'):
+            return self.send_empty(301, {'Location': url_path + '/'}), 0
+        body = format_listing(url_path, local_path)
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_empty(304, {'ETag': etag}), 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+            return 200, len(body)
+        return 200, 0
+
+    def send_file(self, local_path, send_body):
+        size = os.path.getsize(local_path)
+        mtime = os.path.getmtime(local_path)
+        etag = f'"{int(mtime):x}-{size:x}"' # Same form as nginx
+        last_modified = formatdate(mtime, usegmt=True)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range not in (etag, last_modified):
+            range_header = '' # The file changed since the client's copy: send all of it
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            if first.isdigit():
+                start = int(first)
+                end = min(int(last), size - 1) if last.isdigit() else size - 1
+                if start >= size:
+                    return self.send_empty(416, {'Content-Range': f'bytes */{size}'}), 0
+                status = 206
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not send_body:
+            return status, 0
+        faults = self.server.faults
+        if faults.roll(faults.truncate_rate):
+            length //= 2
+            self.close_connection = True
+        sent = 0
+        with open(local_path, 'rb') as f:
+            f.seek(start)
+            began = time.perf_counter()
+            while sent < length:
+                chunk = f.read(min(SEND_CHUNK_SIZE, length - sent))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if faults.bandwidth:
+                    ahead = sent / faults.bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        return status, sent
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, port=0, host='127.0.0.1', faults=None):
+        super().__init__((host, port), MirrorRequestHandler)
+        self.root = os.path.abspath(root)
+        self.faults = faults or FaultConfig()
+        self.stats = RequestStats()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+def start_server(root, port=0, faults=None):
+    """Starts a MirrorServer in a background thread and returns it (stop it with shutdown())."""
+    server = MirrorServer(root, port, faults=faults)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_fault_arguments(parser):
+    """Adds the fault injection options shared by the server and the benchmark runner."""
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to every response (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 500/503 (default: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered with 429 and Retry-After (default: 0)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429/503 (default: 1)')
+    parser.add_argument('--bandwidth', type=float, default=0, help='Bytes per second per response, 0 for unlimited (default: 0)')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='Share of file responses cut off halfway (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for generated data and injected faults (default: 0)')
+
+def get_fault_config(args):
+    return FaultConfig(args.latency, args.error_rate, args.throttle_rate, args.retry_after, args.bandwidth, args.truncate_rate, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a mirror directory like public.bybit.com')
+    parser.add_argument('--root', required=True, help='Mirror directory (see benchmarks/mirror.py)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default: 8765)')
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = MirrorServer(args.root, args.port, faults=get_fault_config(args))
+    logging.info(f"Serving {server.root} at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
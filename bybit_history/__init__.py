@@ -2,4 +2,9 @@
 Bybit History Downloader - instrument for downloading historical data from the public API of Bybit.
 """
 
-__version__ = "0.1.3" 
\ No newline at end of file
+__version__ = "0.1.3"
+
+from .reader import read
+from .replay import replay
+
+__all__ = ['read', 'replay']
@@ -0,0 +1,175 @@
+"""
+OHLCV bar builder: turns downloaded trade files into time bars with vectorized NumPy operations.
+
+Bars for <output_dir>/<data_type>/<SYMBOL>/<file> are written to
+<output_dir>/<data_type>/<SYMBOL>/bars_<interval>/<SYMBOL><date>.csv, one bar file per tick file.
+A bar file is only rebuilt when it is missing or older than its tick file, so repeated runs only
+process newly downloaded or changed days.
+"""
+
+import os
+import re
+import sys
+import logging
+import argparse
+
+from .columnar import get_timestamp_column
+from .optional import import_optional
+from .reader import DEFAULT_BATCH_ROWS, FORMAT_READERS, find_files
+
+BAR_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades', 'buy_volume', 'sell_volume']
+
+# Data types made of individual trades, with the name of their size column
+TRADE_DATA_TYPES = {'trading': 'size', 'spot': 'volume'}
+
+INTERVAL_PATTERN = re.compile(r'(\d+)([smhd])')
+INTERVAL_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_interval(interval):
+    """Converts an interval like '1s', '5m', '1h' or '1d' to seconds."""
+    match = INTERVAL_PATTERN.fullmatch(interval)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid interval: '{interval}'. Use a number followed by s, m, h or d (e.g. 1s, 1m, 1h).")
+    return int(match.group(1)) * INTERVAL_SECONDS[match.group(2)]
+
+def get_bar_path(tick_path, symbol, file_info, interval):
+    """Returns the bar file written for a tick file."""
+    symbol_dir = os.path.dirname(tick_path)
+    return os.path.join(symbol_dir, f"bars_{interval}", f"{symbol}{file_info.start.isoformat()}.csv")
+
+def get_mtime(path):
+    """Modification time of a data file; for a .columns directory, that of its meta.json (written last)."""
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    return os.path.getmtime(path)
+
+# --- Aggregation ---
+def aggregate_batch(np, timestamps, prices, sizes, is_buy, interval_ns):
+    """Computes per-bar partial aggregates for one batch of trades.
+
+    Returns a dict of equally long arrays, one entry per bar touched by the batch: bucket, open/close
+    with the timestamps they were taken at, high, low, volume, notional (price * size), trades and
+    buy_volume. Trades are sorted first if the batch is not already in time order.
+    """
+    if len(timestamps) and np.any(timestamps[1:] < timestamps[:-1]):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, prices, sizes, is_buy = timestamps[order], prices[order], sizes[order], is_buy[order]
+    buckets = timestamps // interval_ns
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)] - 1
+    return {
+        'bucket': buckets[starts],
+        'open': prices[starts],
+        'open_ts': timestamps[starts],
+        'close': prices[ends],
+        'close_ts': timestamps[ends],
+        'high': np.maximum.reduceat(prices, starts),
+        'low': np.minimum.reduceat(prices, starts),
+        'volume': np.add.reduceat(sizes, starts),
+        'notional': np.add.reduceat(prices * sizes, starts),
+        'trades': ends - starts + 1,
+        'buy_volume': np.add.reduceat(np.where(is_buy, sizes, 0.0), starts),
+    }
+
+def combine_partials(np, partials):
+    """Merges partial aggregates from several batches; bars split across batches are combined."""
+    merged = {name: np.concatenate([part[name] for part in partials]) for name in partials[0]}
+    # Group by bucket with the earliest open first, so the group's first row supplies the open price
+    order = np.lexsort((merged['open_ts'], merged['bucket']))
+    merged = {name: values[order] for name, values in merged.items()}
+    starts = np.flatnonzero(np.r_[True, merged['bucket'][1:] != merged['bucket'][:-1]])
+    # The close comes from the row with the latest close timestamp within each group
+    close_order = np.lexsort((merged['close_ts'], merged['bucket']))
+    last_rows = np.r_[starts[1:], len(order)] - 1
+    return {
+        'bucket': merged['bucket'][starts],
+        'open': merged['open'][starts],
+        'high': np.maximum.reduceat(merged['high'], starts),
+        'low': np.minimum.reduceat(merged['low'], starts),
+        'close': merged['close'][close_order][last_rows],
+        'volume': np.add.reduceat(merged['volume'], starts),
+        'notional': np.add.reduceat(merged['notional'], starts),
+        'trades': np.add.reduceat(merged['trades'], starts),
+        'buy_volume': np.add.reduceat(merged['buy_volume'], starts),
+    }
+
+def build_file_bars(np, tick_path, output_format, data_type, interval_seconds, batch_size=DEFAULT_BATCH_ROWS):
+    """Reads one tick file in batches and returns its bars as a dict of arrays (None if it has no trades)."""
+    timestamp_column = get_timestamp_column(data_type)
+    size_column = TRADE_DATA_TYPES[data_type]
+    interval_ns = interval_seconds * 1000000000
+    reader = FORMAT_READERS[output_format]
+    partials = []
+    for batch in reader(np, tick_path, data_type, [timestamp_column, 'price', size_column, 'side'], None, None, batch_size):
+        if not len(batch[timestamp_column]):
+            continue
+        is_buy = np.char.lower(batch['side'].astype(str)) == 'buy'
+        partials.append(aggregate_batch(np, np.asarray(batch[timestamp_column]), np.asarray(batch['price'], dtype=np.float64),
+                                        np.asarray(batch[size_column], dtype=np.float64), is_buy, interval_ns))
+    if not partials:
+        return None
+    bars = combine_partials(np, partials)
+    volume = bars['volume']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bars['vwap'] = np.where(volume > 0, bars['notional'] / volume, np.nan)
+    bars['sell_volume'] = volume - bars['buy_volume']
+    bars['timestamp'] = bars['bucket'] * interval_seconds
+    return bars
+
+def write_bars(np, bars, bar_path):
+    """Writes bars to a CSV (timestamp = bar open time in epoch seconds) through a temporary file."""
+    os.makedirs(os.path.dirname(bar_path), exist_ok=True)
+    tmp_path = f"{bar_path}.tmp"
+    table = np.column_stack([bars[name].astype(np.float64) for name in BAR_COLUMNS])
+    formats = ['%d', '%.15g', '%.15g', '%.15g', '%.15g', '%.15g', '%.15g', '%d', '%.15g', '%.15g']
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        np.savetxt(f, table, delimiter=',', fmt=formats, header=','.join(BAR_COLUMNS), comments='')
+    os.replace(tmp_path, bar_path)
+
+def build_bars(symbols, interval, start, end=None, output_dir='./data', data_type='trading', force=False):
+    """Builds bar files for every tick file of symbols in [start, end]. Returns (built, up_to_date) counts.
+
+    Days whose bar file is newer than the tick file are left untouched unless force is set.
+    """
+    np = import_optional('numpy')
+    if data_type not in TRADE_DATA_TYPES:
+        raise ValueError(f"Bars can only be built from trade data types: {list(TRADE_DATA_TYPES)}")
+    interval_seconds = parse_interval(interval)
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    built = up_to_date = 0
+    for symbol in symbols:
+        for file_info, output_format, tick_path in find_files(data_type, symbol, start, end, output_dir):
+            bar_path = get_bar_path(tick_path, symbol, file_info, interval)
+            if not force and os.path.exists(bar_path) and os.path.getmtime(bar_path) >= get_mtime(tick_path):
+                up_to_date += 1
+                continue
+            logging.info(f"Building {interval} bars: {tick_path} -> {bar_path}")
+            bars = build_file_bars(np, tick_path, output_format, data_type, interval_seconds)
+            if bars is None:
+                logging.warning(f"No trades found in {tick_path}. Skipping.")
+                continue
+            write_bars(np, bars, bar_path)
+            built += 1
+    return built, up_to_date
+
+# --- Command Line ---
+def main(argv=None):
+    """Entry point of the 'bars' subcommand."""
+    parser = argparse.ArgumentParser(prog='start bars', description='Build OHLCV bars from downloaded trade files')
+    parser.add_argument('--coins', required=True, help='Comma-separated list of coin pairs (e.g., BTCUSDT,ETHUSDT)')
+    parser.add_argument('--start-date', required=True, help='Start date in YYYY-MM-DD format')
+    parser.add_argument('--end-date', help='End date in YYYY-MM-DD format (optional)')
+    parser.add_argument('--interval', default='1m', help='Bar interval, e.g. 1s, 1m, 1h (default: 1m)')
+    parser.add_argument('--data-type', default='trading', choices=sorted(TRADE_DATA_TYPES), help='Data type to build bars from (default: trading)')
+    parser.add_argument('--output-dir', default='./data', help='Directory the data was downloaded to (default: ./data)')
+    parser.add_argument('--force', action='store_true', help='Rebuild bars even if they are up to date')
+    args = parser.parse_args(argv)
+
+    symbols = [coin.strip().upper() for coin in args.coins.split(',')]
+    try:
+        built, up_to_date = build_bars(symbols, args.interval, args.start_date, args.end_date, args.output_dir, args.data_type, args.force)
+    except (ValueError, ImportError) as e:
+        logging.error(str(e))
+        sys.exit(1)
+    logging.info(f"--- Finished building {args.interval} bars. Files built: {built}, already up to date: {up_to_date} ---")
@@ -0,0 +1,176 @@
+"""
+Block-compressed CSV storage: independently gzipped blocks plus a sidecar index of block offsets and first timestamps.
+
+A .csv.bgz file is an ordinary multi-member gzip file (zcat/gzip.open read it as one CSV), but every
+member holds whole lines and starts at an offset recorded in <file>.idx, so a reader can seek to the
+blocks covering a time range and decompress only those.
+"""
+
+import os
+import json
+import zlib
+import gzip
+
+from .columnar import SCHEMAS, timestamp_s_to_ns, timestamp_ms_to_ns
+
+BLOCKED_EXTENSION = '.csv.bgz'
+INDEX_EXTENSION = '.idx'
+
+# Uncompressed bytes per block; larger blocks compress better, smaller ones make range reads cheaper
+BLOCK_SIZE = 1024 * 1024
+
+# Level used when re-encoding blocks (6 is gzip's default trade-off between speed and size)
+BLOCK_COMPRESS_LEVEL = 6
+
+def get_index_path(path):
+    """Returns the path of the sidecar index for a blocked file."""
+    return path + INDEX_EXTENSION
+
+def is_blocked_complete(path):
+    """True if path and its index both exist. The index is written last, so this means the file is complete."""
+    return os.path.exists(path) and os.path.exists(get_index_path(path))
+
+def get_timestamp_parser(data_type, header_fields):
+    """Returns (column_position, converter) for the timestamp column of a file, or (None, None) if it has none."""
+    kinds = dict(SCHEMAS.get(data_type, []))
+    for position, name in enumerate(header_fields):
+        if kinds.get(name) == 'timestamp_s':
+            return position, timestamp_s_to_ns
+        if kinds.get(name) == 'timestamp_ms':
+            return position, timestamp_ms_to_ns
+    return None, None
+
+class BlockGzipWriter:
+    """File-like sink that re-encodes a CSV byte stream into gzip blocks of about BLOCK_SIZE bytes.
+
+    Blocks are cut at line boundaries. close() writes the index to <index_path> as JSON:
+    {"header": <first line>, "timestamp_column": <name or null>, "blocks": [[compressed_offset,
+    uncompressed_offset, first_row, first_timestamp_ns], ...], "rows": <total data rows>}.
+    first_row counts data rows (the header is not a row), and first_timestamp_ns is null when the
+    data type has no timestamp column.
+    """
+
+    def __init__(self, path, index_path, data_type):
+        self.file = open(path, 'wb')
+        self.index_path = index_path
+        self.data_type = data_type
+        self.buffer = bytearray()
+        self.header = None
+        self.timestamp_column = None
+        self.timestamp_position = None
+        self.timestamp_converter = None
+        self.blocks = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.rows = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            cut = self.buffer.rfind(b'\n', 0, BLOCK_SIZE) + 1
+            if cut == 0:
+                cut = self.buffer.find(b'\n') + 1 # A single line longer than a block
+                if cut == 0:
+                    return len(data)
+            self.flush_block(bytes(self.buffer[:cut]))
+            del self.buffer[:cut]
+        return len(data)
+
+    def first_timestamp(self, block):
+        """Parses the timestamp of the first data row in block (None if unknown)."""
+        if self.timestamp_converter is None:
+            return None
+        end = block.find(b'\n')
+        fields = block[:end if end >= 0 else len(block)].decode('utf-8').split(',')
+        try:
+            return self.timestamp_converter([fields[self.timestamp_position]])[0]
+        except (IndexError, ValueError):
+            return None
+
+    def flush_block(self, block):
+        first_row = self.rows
+        data = block
+        if self.header is None:
+            # The first line of the file is the header (when it starts with a column name)
+            end = block.find(b'\n')
+            first_line = block[:end if end >= 0 else len(block)].decode('utf-8').rstrip('\r')
+            if first_line[:1].isdigit():
+                self.header = ''
+            else:
+                self.header = first_line
+                data = block[end + 1:]
+                fields = first_line.split(',')
+                self.timestamp_position, self.timestamp_converter = get_timestamp_parser(self.data_type, fields)
+                if self.timestamp_position is not None:
+                    self.timestamp_column = fields[self.timestamp_position]
+        self.rows += data.count(b'\n')
+        if data and not data.endswith(b'\n'):
+            self.rows += 1 # Last line without a trailing newline
+        compressed = gzip.compress(block, compresslevel=BLOCK_COMPRESS_LEVEL, mtime=0)
+        self.blocks.append([self.compressed_offset, self.uncompressed_offset, first_row, self.first_timestamp(data)])
+        self.file.write(compressed)
+        self.compressed_offset += len(compressed)
+        self.uncompressed_offset += len(block)
+
+    def close(self):
+        if self.buffer:
+            self.flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.file.close()
+        index = {
+            'header': self.header or '',
+            'timestamp_column': self.timestamp_column,
+            'block_size': BLOCK_SIZE,
+            'rows': self.rows,
+            'blocks': self.blocks,
+        }
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+def read_index(path):
+    """Loads the sidecar index of a blocked file."""
+    with open(get_index_path(path), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def select_blocks(index, start_ns=None, end_ns=None):
+    """Returns the positions of the blocks that can hold rows with start_ns <= timestamp <= end_ns.
+
+    Relies on rows being sorted by timestamp (as Bybit's files are). Without a timestamp column,
+    or without bounds, every block is selected.
+    """
+    blocks = index['blocks']
+    if index.get('timestamp_column') is None or (start_ns is None and end_ns is None):
+        return list(range(len(blocks)))
+    selected = []
+    for position, block in enumerate(blocks):
+        first = block[3]
+        next_first = blocks[position + 1][3] if position + 1 < len(blocks) else None
+        if end_ns is not None and first is not None and first > end_ns:
+            break
+        if start_ns is not None and next_first is not None and next_first < start_ns:
+            continue
+        selected.append(position)
+    return selected
+
+def iter_blocks(path, start_ns=None, end_ns=None, index=None):
+    """Yields (position, data) with the decompressed bytes of each block that may hold rows in [start_ns, end_ns].
+
+    Block 0 still starts with the header line (if the file has one); later blocks hold data rows only.
+    """
+    index = index or read_index(path)
+    blocks = index['blocks']
+    with open(path, 'rb') as f:
+        for position in select_blocks(index, start_ns, end_ns):
+            f.seek(blocks[position][0])
+            end = blocks[position + 1][0] if position + 1 < len(blocks) else None
+            compressed = f.read(end - blocks[position][0]) if end is not None else f.read()
+            yield position, zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
@@ -1,14 +1,32 @@
-import urllib.request
 import os
-import re
 import gzip
+import json
 import time
+import zlib
 import requests
-from bs4 import BeautifulSoup
 import argparse
 import sys
+import importlib
+import sqlite3
+import threading
 import logging # Import logging
-from datetime import datetime # Import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime # Import datetime
+from urllib.parse import unquote
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+from . import metrics
+from .listing import ListingCache, LISTING_CACHE_FILENAME
+from .catalog import Catalog, FileStats
+from .leases import DEFAULT_LEASE_TTL, LeaseManager
+from .sharding import format_shard, in_shard, parse_shard
+from .planner import PLAN_ORDERS, DownloadJob, format_plan_summary, format_size, load_plan, order_jobs, save_plan
+from .ratelimit import DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_RATE, RateController, check_response
+from .columnar import OUTPUT_FORMATS, check_format_dependencies, convert_csv, get_output_path
+from .blockgz import BLOCKED_EXTENSION, BlockGzipWriter, get_index_path, is_blocked_complete
+from .timeindex import DEFAULT_INDEX_ROWS, DEFAULT_INDEX_SECONDS, TimeIndexWriter
+from .filenames import SYMBOL_PATTERN, YEAR_PATTERN, parse_filename, year_in_range
 
 
 # --- Configuration & Constants ---
@@ -19,6 +37,26 @@ ver = '1.5:YYYY-MM-DD' # TODO: Update date when finalizing
 # TODO: Verify and potentially expand this list
 KNOWN_DATA_TYPES = ['trading', 'spot', 'kline_for_metatrader4', 'premium_index', 'spot_index']
 
+# Size of the pieces read from the network and written to disk when streaming
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_BASE_URL = 'https://public.bybit.com/'
+
+# Directory listings fetched in parallel while planning
+DEFAULT_CRAWL_WORKERS = 8
+
+# Most seconds between attempts at files leased by other workers (with --leases)
+LEASE_POLL_SECONDS = 10
+
+# Subcommands (first command line argument) and the (module, function) implementing them. Without one, the
+# arguments are the download options, as before.
+SUBCOMMANDS = {
+    'bars': ('.bars', 'main'),
+    'status': ('.catalog', 'status_main'),
+    'gaps': ('.catalog', 'gaps_main'),
+    'replay': ('.replay', 'main'),
+}
+
 # Setup basic logging
 # TODO: Make logging configurable (level, file output) via args
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,6 +70,36 @@ def validate_date_format(date_string):
     except ValueError:
         raise argparse.ArgumentTypeError(f"Invalid date format: '{date_string}'. Please use YYYY-MM-DD.")
 
+def validate_positive_int(value):
+    """Validates that a string is a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a positive integer.")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a positive integer.")
+    return number
+
+def validate_positive_float(value):
+    """Validates that a string is a number > 0."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a positive number.")
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a positive number.")
+    return number
+
+def validate_non_negative_float(value):
+    """Validates that a string is a number >= 0."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a number >= 0.")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"Invalid number: '{value}'. Please use a number >= 0.")
+    return number
+
 def parse_arguments():
     """Parses command-line arguments."""
     parser = argparse.ArgumentParser(description='Bybit Historical Data Downloader')
@@ -40,7 +108,28 @@ def parse_arguments():
     parser.add_argument('--coins', required=True, help="Comma-separated list of coin pairs (e.g., BTCUSDT,ETHUSDT) or 'ALL'")
     parser.add_argument('--data-types', default='trading', help=f"Comma-separated list of data types (e.g., trading,spot) or 'ALL'. Default: trading. Known types: {', '.join(KNOWN_DATA_TYPES)}")
     parser.add_argument('--output-dir', default='./data', help='Directory to save downloaded data (default: ./data)')
-    parser.add_argument('--base-url', default='https://public.bybit.com/', help='Base URL for Bybit public data (default: https://public.bybit.com/)')
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL, help=f'Base URL for Bybit public data (default: {DEFAULT_BASE_URL})')
+    parser.add_argument('--sync', action='store_true', help='Only walk directories whose listing changed since the last complete run (uses the listing cache in the output directory)')
+    parser.add_argument('--stream-extract', action='store_true', help='Decompress while downloading, without writing the .csv.gz archive to disk')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv', help='Format of the saved files: csv (as published), parquet or npy (typed columns), bgzip (compressed, indexed blocks). Default: csv')
+    parser.add_argument('--workers', type=validate_positive_int, default=1, help='Number of files to download in parallel (default: 1)')
+    parser.add_argument('--crawl-workers', type=validate_positive_int, default=DEFAULT_CRAWL_WORKERS, help=f'Number of directory listings fetched in parallel while planning (default: {DEFAULT_CRAWL_WORKERS})')
+    parser.add_argument('--dry-run', action='store_true', help='Only plan: print the files that would be downloaded and their total size, without downloading anything')
+    parser.add_argument('--plan-file', help='Save the plan (the files selected by the crawl) to this JSON file')
+    parser.add_argument('--from-plan', help='Download the files of a plan saved with --plan-file instead of crawling the listings')
+    parser.add_argument('--order', choices=PLAN_ORDERS, default='date', help='Order in which planned files are downloaded: date (oldest first), size (smallest first) or size-desc (default: date)')
+    parser.add_argument('--no-catalog', action='store_true', help='Do not keep the catalog of downloaded files (<output-dir>/.catalog.sqlite), e.g. on network file systems where SQLite locking is unreliable')
+    parser.add_argument('--recheck', action='store_true', help='Check every planned file on disk instead of skipping files the catalog lists as downloaded (e.g. after deleting files)')
+    parser.add_argument('--index-rows', type=validate_positive_int, default=DEFAULT_INDEX_ROWS, help=f'With --output-format csv, add a time index entry (<file>.csv.idx) at least every this many rows (default: {DEFAULT_INDEX_ROWS})')
+    parser.add_argument('--index-seconds', type=validate_positive_float, default=DEFAULT_INDEX_SECONDS, help=f'With --output-format csv, add a time index entry at least every this many seconds of data (default: {DEFAULT_INDEX_SECONDS})')
+    parser.add_argument('--no-time-index', action='store_true', help='Do not write the time index sidecar of extracted CSV files')
+    parser.add_argument('--max-rate', type=validate_non_negative_float, default=DEFAULT_MAX_RATE, help=f'Most requests per second sent to the server; lowered automatically when it throttles, 0 for no limit (default: {DEFAULT_MAX_RATE:g})')
+    parser.add_argument('--max-attempts', type=validate_positive_int, default=DEFAULT_MAX_ATTEMPTS, help=f'Attempts per request before giving up, with jittered exponential backoff between them (default: {DEFAULT_MAX_ATTEMPTS})')
+    parser.add_argument('--shard', type=parse_shard, help='Only handle shard i of N (e.g. 1/4): files are split by a hash of data type, symbol and date, so N instances with 1/N..N/N cover everything once')
+    parser.add_argument('--leases', action='store_true', help='Lease each file through a lock file in <output-dir>/.leases before downloading it, so several processes can share one output directory')
+    parser.add_argument('--lease-ttl', type=validate_positive_float, default=DEFAULT_LEASE_TTL, help=f'Seconds after which a lease that is no longer refreshed (crashed worker) is reclaimed (default: {DEFAULT_LEASE_TTL:g})')
+    parser.add_argument('--metrics-file', help='Write per-stage timings, byte counts and retries to this file: JSON if it ends with .json, otherwise Prometheus textfile format')
+    parser.add_argument('--metrics-interval', type=validate_non_negative_float, default=60, help='Seconds between metrics file updates during the run (default: 60; 0 writes it only at the end)')
     parser.add_argument('--version', action='version', version=f'%(prog)s {ver}')
     # TODO: Add arguments for logging level, log file, etc.
 
@@ -67,6 +156,13 @@ def parse_arguments():
                 logging.error(f"Unknown data type '{dt}'. Please use one of {KNOWN_DATA_TYPES} or 'ALL'.")
                 sys.exit(1) # Exit if unknown type is specified
 
+    # Columnar formats need numpy (and pyarrow for parquet); fail before downloading anything
+    try:
+        check_format_dependencies(args.output_format)
+    except ImportError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
     logging.info("--- Configuration ---")
     logging.info(f"Start Date: {args.start_date}")
     logging.info(f"End Date: {args.end_date if args.end_date else 'Not set'}")
@@ -74,6 +170,17 @@ def parse_arguments():
     logging.info(f"Data Types: {', '.join(target_data_types)}")
     logging.info(f"Output Directory: {args.output_dir}")
     logging.info(f"Base URL: {args.base_url}")
+    logging.info(f"Workers: {args.workers}")
+    logging.info(f"Max Rate: {args.max_rate:g} requests/s" if args.max_rate else "Max Rate: unlimited")
+    logging.info(f"Max Attempts: {args.max_attempts}")
+    logging.info(f"Shard: {format_shard(args.shard) if args.shard else 'Not set'}")
+    logging.info(f"Leases: {f'on (TTL {args.lease_ttl:g}s)' if args.leases else 'off'}")
+    logging.info(f"Stream Extract: {args.stream_extract}")
+    logging.info(f"Sync Mode: {args.sync}")
+    logging.info(f"Output Format: {args.output_format}")
+    if args.output_format == 'csv':
+        logging.info(f"Time Index: every {args.index_rows} rows / {args.index_seconds:g}s" if not args.no_time_index else "Time Index: off")
+    logging.info(f"Metrics File: {args.metrics_file if args.metrics_file else 'Not set'}")
     logging.info("---------------------")
 
     return args, target_coins, target_data_types
@@ -90,302 +197,921 @@ start_date = '2024-10-01'
 # Set the list of coins
 coins = ['BTCUSDT', 'ETHUSDT', 'XVGUSDT']
 
-# Create a function to download the files
-def download_file(url, local_path):
-    with urllib.request.urlopen(url) as response, open(local_path, 'wb') as out_file:
-        data = response.read()
-        out_file.write(data)
+# --- HTTP Session ---
+# One Session is shared by all listing and file requests so TCP/TLS connections
+# are kept alive and reused instead of being re-established for every file.
+_session = None
+_session_lock = threading.Lock()
+
+def create_session(pool_size=1):
+    """Returns a new Session with a connection pool large enough for pool_size workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def configure_session(pool_size=1):
+    """Creates the shared Session with a connection pool large enough for pool_size workers."""
+    global _session
+    session = create_session(pool_size)
+    with _session_lock:
+        _session = session
+    return session
+
+def get_session():
+    """Returns the shared Session, creating a default one on first use."""
+    with _session_lock:
+        session = _session
+    if session is None:
+        session = configure_session()
+    return session
+
+# --- Rate Control ---
+# Every request (listings and files) is admitted and retried by one controller, see ratelimit.py
+_rate_controller = RateController()
+
+def configure_rate_controller(max_rate=DEFAULT_MAX_RATE, max_window=1, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Creates the shared RateController; max_window is the most requests allowed in flight per host."""
+    global _rate_controller
+    _rate_controller = RateController(max_rate, max_window, max_attempts)
+    return _rate_controller
+
+# --- Directory Listings ---
+# Listings are revalidated against a persistent cache (ETag/Last-Modified + parsed links)
+_listing_cache = ListingCache()
+
+def configure_listing_cache(path):
+    """Loads the persistent listing cache stored at path."""
+    global _listing_cache
+    _listing_cache = ListingCache(path)
+    return _listing_cache
+
+# --- Work Leases ---
+# With --leases, every file is leased before it is downloaded, so processes sharing the output directory split the work
+_lease_manager = None
+
+def configure_leases(output_dir, ttl=DEFAULT_LEASE_TTL):
+    """Starts the lease manager for output_dir (and its background refresh)."""
+    global _lease_manager
+    _lease_manager = LeaseManager(output_dir, ttl).start()
+    return _lease_manager
+
+# --- Catalog ---
+# Downloaded files are recorded in <output_dir>/.catalog.sqlite, see catalog.py
+_catalog = None
+
+def configure_catalog(output_dir):
+    """Opens the catalog of output_dir."""
+    global _catalog
+    _catalog = Catalog(output_dir)
+    return _catalog
+
+# --- Time Index ---
+# Extracted CSV files get a <file>.idx sidecar of byte offsets by time, see timeindex.py; None disables it
+_time_index_spacing = (DEFAULT_INDEX_ROWS, DEFAULT_INDEX_SECONDS)
+
+def configure_time_index(every_rows=DEFAULT_INDEX_ROWS, every_seconds=DEFAULT_INDEX_SECONDS, enabled=True):
+    """Sets how often time index entries are written (or turns the index off)."""
+    global _time_index_spacing
+    _time_index_spacing = (every_rows, every_seconds) if enabled else None
+    return _time_index_spacing
+
+class Listings:
+    """The ListingCache, Session and RateController that directory listings are fetched with."""
+
+    def __init__(self, cache, session, rate_controller):
+        self.cache = cache
+        self.session = session
+        self.rate_controller = rate_controller
+
+    def fetch(self, url):
+        return self.rate_controller.call(url, lambda: self.cache.fetch(self.session, url), 'listing_fetch')
+
+def get_shared_listings():
+    """Returns Listings using the shared listing cache, Session and RateController (set up by main)."""
+    return Listings(_listing_cache, get_session(), _rate_controller)
+
+def fetch_listing(url, listings=None):
+    """Returns (links, changed) for a directory URL; links is a list of (href, text, size) tuples.
 
+    listings defaults to the shared ones. Throttling, server errors and dropped connections are
+    retried by the rate controller.
+    """
+    return (listings or get_shared_listings()).fetch(url)
+
+def get_date_window(args):
+    """Returns the requested (start_date, end_date) as datetime.date objects; end_date is None if not set."""
+    start_date = date.fromisoformat(args.start_date)
+    end_date = date.fromisoformat(args.end_date) if args.end_date else None
+    return start_date, end_date
+
+def get_sync_key(data_type_name, args, target_coins):
+    """Describes the filters of this run; a directory walked with other filters is not 'complete' for --sync."""
+    shard = format_shard(args.shard) if args.shard else ''
+    return f"{data_type_name}|{args.start_date}|{args.end_date or ''}|{','.join(sorted(target_coins))}|{args.output_format}|{shard}"
 
 # Create a function to check if a file exists
 def file_exists(local_path):
     return os.path.exists(local_path)
 
-def download_and_extract(csv_url, archive_path, extracted_path):
-    """Downloads a gzipped CSV, extracts it, and removes the archive."""
-    download_successful = False
-    # Download the archive file if the extracted file doesn't exist
-    if not file_exists(extracted_path):
-        # Also check if archive exists (e.g., from interrupted previous run)
-        if not file_exists(archive_path):
+def remove_quietly(path):
+    """Removes a file if it exists, ignoring errors (used for cleanup after failures)."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def extraction_exists(extracted_path):
+    """True if a complete extracted file exists (for blocked gzip files, the index must exist too)."""
+    if extracted_path.endswith(BLOCKED_EXTENSION):
+        return is_blocked_complete(extracted_path)
+    return file_exists(extracted_path)
+
+def open_extracted_output(tmp_path, block_data_type=None, index_data_type=None):
+    """Opens what extraction writes to: a plain file, a BlockGzipWriter or a TimeIndexWriter.
+
+    block_data_type selects the blocked gzip format; otherwise index_data_type selects a plain CSV
+    with a time index sidecar, unless the time index is turned off.
+    """
+    if block_data_type is not None:
+        return BlockGzipWriter(tmp_path, get_index_path(tmp_path), block_data_type)
+    if index_data_type is not None and _time_index_spacing is not None:
+        return TimeIndexWriter(tmp_path, get_index_path(tmp_path), index_data_type, *_time_index_spacing)
+    return open(tmp_path, 'wb')
+
+def promote_extracted_output(tmp_path, extracted_path):
+    """Renames a finished extraction into place. A blocked file's index is moved last, marking it complete."""
+    os.replace(tmp_path, extracted_path)
+    if file_exists(get_index_path(tmp_path)):
+        os.replace(get_index_path(tmp_path), get_index_path(extracted_path))
+
+def remove_extracted_output(tmp_path):
+    """Removes an unfinished extraction and its index, if any."""
+    remove_quietly(tmp_path)
+    remove_quietly(get_index_path(tmp_path))
+
+def iter_decompressed(chunks, timings=None):
+    """Incrementally gunzips an iterable of byte chunks, yielding the output in pieces of at most STREAM_CHUNK_SIZE.
+
+    Memory use does not depend on the file size. Multi-member gzip streams are supported. Raises
+    EOFError if the stream ends before the gzip trailer (i.e. the download was truncated); zlib
+    itself checks the trailer CRC/size. Time spent in zlib is added to timings['decompress'] and
+    the compressed bytes read to timings['in'], if timings is given.
+    """
+    if timings is None:
+        timings = {}
+    timings.setdefault('decompress', 0.0)
+    timings.setdefault('in', 0)
+    clock = time.perf_counter
+
+    def decompress(decompressor, data):
+        started = clock()
+        out = decompressor.decompress(data, STREAM_CHUNK_SIZE)
+        timings['decompress'] += clock() - started
+        return out
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_open = False
+    for data in chunks:
+        timings['in'] += len(data)
+        if data:
+            member_open = True
+        while data:
+            out = decompress(decompressor, data)
+            yield out
+            if decompressor.eof:
+                # End of one gzip member; anything left over is the start of the next one
+                data = decompressor.unused_data.lstrip(b'\0')
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member_open = bool(data)
+                continue
+            data = decompressor.unconsumed_tail
+            if not data and len(out) == STREAM_CHUNK_SIZE:
+                # Output was capped; drain whatever zlib still holds for the consumed input
+                data = b''
+                while True:
+                    out = decompress(decompressor, b'')
+                    yield out
+                    if len(out) < STREAM_CHUNK_SIZE or decompressor.eof:
+                        break
+                if decompressor.eof:
+                    data = decompressor.unused_data.lstrip(b'\0')
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_open = bool(data)
+    if member_open:
+        raise EOFError("Compressed stream ended before the end-of-stream marker was reached")
+
+def decompress_stream(chunks, f_out, stats=None):
+    """Incrementally gunzips an iterable of byte chunks into f_out (see iter_decompressed). Returns the number of bytes written.
+
+    Time spent decompressing and writing is recorded under the decompress and write stages. The
+    decompressed bytes are also fed to stats (a catalog.FileStats), if given.
+    """
+    if stats is not None:
+        stats.reset()
+    timings = {}
+    write_seconds = 0.0
+    written = 0
+    clock = time.perf_counter
+    try:
+        for out in iter_decompressed(chunks, timings):
+            if stats is not None:
+                stats.feed(out)
+            started = clock()
+            f_out.write(out)
+            write_seconds += clock() - started
+            written += len(out)
+    finally:
+        record_extraction(timings.get('decompress', 0.0), write_seconds, timings.get('in', 0), written)
+    return written
+
+def record_extraction(decompress_seconds, write_seconds, bytes_in, bytes_out):
+    """Records the metrics of one file's extraction."""
+    metrics.observe('decompress', decompress_seconds)
+    metrics.observe('write', write_seconds)
+    metrics.add('bytes_in_total', bytes_in, stage='decompress')
+    metrics.add('bytes_out_total', bytes_out, stage='decompress')
+    metrics.add('bytes_out_total', bytes_out, stage='write')
+
+def iter_timed(chunks, stage):
+    """Yields from chunks, recording the time spent waiting for them and their total size under stage.
+
+    The metrics are recorded once, when the iteration ends (or is abandoned).
+    """
+    chunks = iter(chunks)
+    waited = 0.0
+    size = 0
+    clock = time.perf_counter
+    try:
+        while True:
+            started = clock()
             try:
-                logging.info(f'Downloading: {csv_url} to {archive_path}')
-                # Use requests for consistency and better error handling
-                response = requests.get(csv_url, stream=True)
-                response.raise_for_status()
-                with open(archive_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                time.sleep(0.1) # Be polite
-                download_successful = True
-            except requests.exceptions.RequestException as e:
-                logging.error(f"Error downloading {csv_url}: {e}")
-                # Attempt to clean up potentially corrupted file
-                if file_exists(archive_path):
-                    try:
-                        os.remove(archive_path)
-                    except OSError as oe:
-                        logging.warning(f"Could not remove partially downloaded file {archive_path}: {oe}")
-                return False # Indicate failure
-            except Exception as e: # Catch other potential errors during download/write
-                logging.error(f"An unexpected error occurred during download of {csv_url}: {e}")
-                if file_exists(archive_path):
-                    try: os.remove(archive_path)
-                    except OSError as oe: pass # Ignore cleanup error
-                return False
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                waited += clock() - started
+            size += len(chunk)
+            yield chunk
+    finally:
+        metrics.observe(stage, waited)
+        metrics.add('bytes_in_total', size, stage=stage)
+
+class IncompleteDownloadError(Exception):
+    """Raised when fewer bytes arrived than the server announced."""
+
+def iter_response_bytes(response):
+    """Yields the raw body of a streamed response, exactly as stored on the server (no Content-Encoding decoding)."""
+    try:
+        yield from response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+    except Urllib3HTTPError as e:
+        # Reading .raw bypasses requests' own wrapping; map dropped connections to a requests error
+        raise requests.exceptions.ConnectionError(e)
+
+def get_expected_size(response, offset=0):
+    """Returns the full size of the remote file from Content-Range/Content-Length, or None if unknown."""
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return offset + int(content_length)
+    return None
+
+def get_validator_path(part_path):
+    """Returns the path where the validator (ETag/Last-Modified) of the remote file behind a .part is kept."""
+    return part_path + '.validator'
+
+def read_validator(part_path):
+    """Returns the If-Range value for resuming part_path: its remote file's strong ETag or Last-Modified, or None."""
+    try:
+        with open(get_validator_path(part_path), 'r', encoding='utf-8') as f:
+            validator = json.load(f)
+    except (OSError, ValueError):
+        return None
+    etag = validator.get('etag')
+    if etag and not etag.startswith('W/'): # If-Range only accepts strong ETags
+        return etag
+    return validator.get('last_modified')
+
+def write_validator(part_path, response):
+    """Records the ETag/Last-Modified of the response that part_path is being written from."""
+    with open(get_validator_path(part_path), 'w', encoding='utf-8') as f:
+        json.dump({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}, f)
+
+def remove_part(part_path):
+    """Removes a .part file and its validator."""
+    remove_quietly(part_path)
+    remove_quietly(get_validator_path(part_path))
+
+def download_to_part(csv_url, part_path, stats=None):
+    """Downloads csv_url into part_path, resuming from the bytes already there with a Range request.
+
+    Returns normally only when part_path holds as many bytes as the server announced. Raises
+    IncompleteDownloadError on a short transfer, leaving part_path in place so the next attempt
+    (or the next run) continues from where this one stopped. The remote file's ETag/Last-Modified
+    is kept next to the .part and sent as If-Range when resuming, so if the file changed the server
+    sends all of it again instead of bytes that do not fit. The response's ETag is stored in stats.
+    """
+    offset = os.path.getsize(part_path) if file_exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        validator = read_validator(part_path)
+        if validator:
+            headers['If-Range'] = validator
+    with get_session().get(csv_url, stream=True, headers=headers) as response:
+        if response.status_code == 416:
+            # Nothing left to request: the .part is either complete or longer than the remote file
+            if get_expected_size(response) == offset:
+                return
+            remove_part(part_path)
+            raise IncompleteDownloadError(f"Partial file {part_path} does not match the remote file; restarting")
+        check_response(response)
+        if stats is not None:
+            stats.etag = response.headers.get('ETag')
+        if response.status_code == 206:
+            logging.info(f"Resuming {csv_url} from byte {offset}")
+            mode = 'ab'
         else:
-             logging.info(f"Archive file {archive_path} already exists. Proceeding to extraction.")
-             download_successful = True # Archive exists, ready for extraction attempt
+            if offset:
+                logging.info(f"Downloading {csv_url} again from the start - the server sent the whole file (changed since the partial download)")
+            offset = 0 # Server ignored the Range header (or If-Range did not match) and sent the whole file
+            mode = 'wb'
+        expected_size = get_expected_size(response, offset)
+        write_seconds = 0.0
+        with open(part_path, mode) as f:
+            if mode == 'wb':
+                write_validator(part_path, response)
+            for chunk in iter_timed(iter_response_bytes(response), 'download'):
+                started = time.perf_counter()
+                f.write(chunk)
+                write_seconds += time.perf_counter() - started
+        metrics.observe('archive_write', write_seconds)
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IncompleteDownloadError(f"Received {size} of {expected_size} bytes for {csv_url}")
+
+def stream_to_tmp(csv_url, tmp_path, block_data_type=None, stats=None, index_data_type=None):
+    """One attempt at downloading csv_url and decompressing it into tmp_path (overwritten)."""
+    with get_session().get(csv_url, stream=True) as response:
+        check_response(response)
+        expected_size = get_expected_size(response)
+        received = 0
+        def counted(chunks):
+            nonlocal received
+            for chunk in chunks:
+                received += len(chunk)
+                yield chunk
+        with open_extracted_output(tmp_path, block_data_type, index_data_type) as f_out:
+            decompress_stream(counted(iter_timed(iter_response_bytes(response), 'download')), f_out, stats)
+    if expected_size is not None and received != expected_size:
+        raise IncompleteDownloadError(f"Received {received} of {expected_size} bytes for {csv_url}")
+    if stats is not None:
+        stats.size = received
+        stats.etag = response.headers.get('ETag')
+
+def stream_download_and_extract(csv_url, extracted_path, block_data_type=None, stats=None, index_data_type=None):
+    """Downloads a gzipped CSV and decompresses it on the fly, without writing the archive to disk.
+
+    Data is written to a temporary name and renamed into place only once the whole stream has
+    been received and decompressed, so a partial file never appears under the final name. There is
+    no archive to resume from in this mode, so a retry starts again from the beginning.
+    """
+    if extraction_exists(extracted_path):
+        logging.info(f"Skipping download/extraction - extracted file {extracted_path} already exists.")
+        metrics.add('files_total', result='skipped')
+        return True
+    tmp_path = f"{extracted_path}.tmp"
+    try:
+        logging.info(f'Streaming: {csv_url} to {extracted_path}')
+        _rate_controller.call(csv_url, lambda: stream_to_tmp(csv_url, tmp_path, block_data_type, stats, index_data_type), 'download', retry_on=(IncompleteDownloadError,))
+        promote_extracted_output(tmp_path, extracted_path)
+        metrics.add('files_total', result='downloaded')
+        return True
+    except (requests.exceptions.RequestException, IncompleteDownloadError) as e:
+        logging.error(f"Error downloading {csv_url}: {e}")
+    except (zlib.error, EOFError) as e:
+        logging.error(f"Bad Gzip stream from {csv_url}. It might be corrupted or truncated: {e}")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred while streaming {csv_url}: {e}")
+    finally:
+        remove_extracted_output(tmp_path)
+    return False
 
-    # Extract the gzip archive if download was successful (or archive already existed)
-    # and extracted file doesn't exist yet
-    if download_successful and not file_exists(extracted_path):
+def download_and_extract(csv_url, archive_path, extracted_path, stream=False, block_data_type=None, stats=None, index_data_type=None):
+    """Downloads a gzipped CSV, extracts it, and removes the archive.
+
+    The archive is downloaded to <archive>.part, resumed with Range requests after a failure, and
+    only renamed to <archive> once its length matches what the server announced. Extraction goes
+    through <csv>.tmp and is only renamed into place after gzip has checked the trailer CRC and size,
+    so a truncated or corrupted archive never becomes a short CSV. With stream=True the archive is
+    never written; see stream_download_and_extract. With block_data_type set, the CSV is stored
+    re-compressed in indexed blocks (see blockgz.py) instead of as plain text. stats (a
+    catalog.FileStats) receives the archive's size, ETag and content statistics; it stays empty when
+    the file already existed. With index_data_type set, a plain CSV gets a time index sidecar
+    built from the same pass (see timeindex.py).
+    """
+    if extraction_exists(extracted_path):
+        logging.info(f"Skipping download/extraction - extracted file {extracted_path} already exists.")
+        metrics.add('files_total', result='skipped')
+        return True # Already exists counts as success for this file
+    if stream and not file_exists(archive_path):
+        return stream_download_and_extract(csv_url, extracted_path, block_data_type, stats, index_data_type)
+
+    # Download the archive file unless a verified one exists (e.g., from interrupted previous run)
+    archive_left_over = file_exists(archive_path)
+    part_path = f"{archive_path}.part"
+    part_left_over = False
+    if not archive_left_over:
+        part_left_over = file_exists(part_path)
         try:
-            logging.info(f'Extracting: {archive_path} to {extracted_path}')
-            with gzip.open(archive_path, 'rb') as f_in:
-                with open(extracted_path, 'wb') as f_out:
-                    f_out.write(f_in.read())
-            # Remove the archive file after successful extraction
-            try:
-                os.remove(archive_path)
-                # logging.info(f'Removed archive: {archive_path}') # A bit verbose
-            except OSError as e:
-                logging.warning(f"Could not remove archive file {archive_path}: {e}")
-            return True # Indicate success
-        except gzip.BadGzipFile:
-            logging.error(f"Bad Gzip file {archive_path}. It might be corrupted or not a gzip file.")
-            # Optionally remove bad archive: os.remove(archive_path)
-            return False # Indicate failure
-        except Exception as e:
-            logging.error(f"Error extracting {archive_path}: {e}")
-            return False # Indicate failure
-    elif file_exists(extracted_path):
-         logging.info(f"Skipping download/extraction - extracted file {extracted_path} already exists.")
-         return True # Already exists counts as success for this file
+            logging.info(f'Downloading: {csv_url} to {part_path}')
+            # Retries resume from the .part file
+            _rate_controller.call(csv_url, lambda: download_to_part(csv_url, part_path, stats), 'download', retry_on=(IncompleteDownloadError,))
+            os.replace(part_path, archive_path) # Length verified, promote the archive
+            remove_quietly(get_validator_path(part_path))
+        except (requests.exceptions.RequestException, IncompleteDownloadError) as e:
+            # Keep the .part file: the next run resumes from it
+            logging.error(f"Error downloading {csv_url}: {e}")
+            return False
+        except Exception as e: # Catch other potential errors during download/write
+            logging.error(f"An unexpected error occurred during download of {csv_url}: {e}")
+            return False
     else:
-         # Download failed in the block above, message already logged
-         return False # Indicate failure
+        logging.info(f"Archive file {archive_path} already exists. Proceeding to extraction.")
+
+    # Extract the gzip archive; gzip validates the CRC and size in each member's trailer at EOF
+    tmp_path = f"{extracted_path}.tmp"
+    try:
+        logging.info(f'Extracting: {archive_path} to {extracted_path}')
+        # Copy in fixed-size pieces so a multi-GB CSV never has to fit in memory
+        with open(archive_path, 'rb') as f_in:
+            with open_extracted_output(tmp_path, block_data_type, index_data_type) as f_out:
+                decompress_stream(iter(lambda: f_in.read(STREAM_CHUNK_SIZE), b''), f_out, stats)
+        promote_extracted_output(tmp_path, extracted_path)
+        if stats is not None:
+            stats.size = os.path.getsize(archive_path)
+        metrics.add('files_total', result='downloaded')
+        # Remove the archive file after successful extraction
+        try:
+            os.remove(archive_path)
+            # logging.info(f'Removed archive: {archive_path}') # A bit verbose
+        except OSError as e:
+            logging.warning(f"Could not remove archive file {archive_path}: {e}")
+        return True # Indicate success
+    except (gzip.BadGzipFile, EOFError, zlib.error) as e:
+        # Truncated or corrupted archive: drop it so it is downloaded again
+        logging.error(f"Bad Gzip file {archive_path}. It might be corrupted or truncated, removing it: {e}")
+        remove_extracted_output(tmp_path)
+        remove_quietly(archive_path)
+        if archive_left_over or part_left_over:
+            # Left behind (or resumed from a .part left) by an older run, so fetching a fresh copy once is worth it
+            return download_and_extract(csv_url, archive_path, extracted_path, stream=stream, block_data_type=block_data_type, stats=stats, index_data_type=index_data_type)
+        return False # Indicate failure
+    except Exception as e:
+        logging.error(f"Error extracting {archive_path}: {e}")
+        remove_extracted_output(tmp_path)
+        return False # Indicate failure
 
 # --- File Processing Logic ---
-def process_directory(current_url, current_output_path, data_type_name, args, target_coins):
-    """Recursively processes a directory, downloading and extracting relevant files."""
-    logging.info(f"Processing directory: {current_url}")
+def download_job(job, args):
+    """Runs download_and_extract for one DownloadJob.
+
+    Returns True on success, False on failure, and None if another worker holds the file's lease
+    (with --leases; run_download_jobs tries again later). For columnar output formats the extracted
+    CSV is then converted and removed. The bgzip format is written directly during extraction.
+    """
+    if _lease_manager is None:
+        return process_job(job, args)
+    lease_key = os.path.relpath(job.extracted_path, args.output_dir)
+    if not _lease_manager.acquire(lease_key):
+        return None
+    try:
+        return process_job(job, args)
+    finally:
+        _lease_manager.release(lease_key)
+
+def process_job(job, args):
+    """Downloads, extracts and (for columnar formats) converts the file of one job; see download_job.
+
+    The finished file (or an existing one found on disk) is recorded in the catalog.
+    """
+    extracted_path = output_path = job.extracted_path
+    block_data_type = None
+    index_data_type = job.data_type if args.output_format == 'csv' else None
+    if args.output_format == 'bgzip':
+        extracted_path = output_path = get_output_path(extracted_path, args.output_format)
+        block_data_type = job.data_type
+    elif args.output_format != 'csv':
+        output_path = get_output_path(extracted_path, args.output_format)
+        if file_exists(output_path):
+            logging.info(f"Skipping download/extraction - converted file {output_path} already exists.")
+            metrics.add('files_total', result='skipped')
+            record_in_catalog(job, output_path, args.output_format, removed_path=extracted_path)
+            return True
+    stats = FileStats(job.data_type) if _catalog is not None else None
+    os.makedirs(os.path.dirname(job.archive_path), exist_ok=True)
+    logging.info(f"Downloading file: {job.name}, date: {job.date}")
+    if not download_and_extract(job.url, job.archive_path, extracted_path, stream=args.stream_extract, block_data_type=block_data_type, stats=stats, index_data_type=index_data_type):
+        logging.warning(f"Failed to download or extract file: {job.name}")
+        metrics.add('files_total', result='failed')
+        return False
+    if args.output_format not in ('csv', 'bgzip') and not convert_csv(extracted_path, output_path, job.data_type, args.output_format):
+        logging.warning(f"Failed to convert file: {job.name}")
+        metrics.add('files_total', result='convert_failed')
+        return False
+    # Conversion removes the CSV, which may have been cataloged by an earlier csv run
+    record_in_catalog(job, output_path, args.output_format, stats, removed_path=extracted_path if output_path != extracted_path else None)
+    logging.info(f"Successfully processed file: {job.name}")
+    return True
+
+def record_in_catalog(job, output_path, output_format, stats=None, removed_path=None):
+    """Records a finished file in the catalog (if enabled), and forgets removed_path. A catalog error is logged, not fatal."""
+    if _catalog is None:
+        return
     try:
-        response = requests.get(current_url)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching directory URL {current_url}: {e}")
-        return 0, 0 # Stop processing this branch if listing fails
+        _catalog.record(job, output_path, output_format, stats)
+        if removed_path is not None and not file_exists(removed_path):
+            _catalog.remove(removed_path)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not record {job.name} in the catalog: {e}")
+
+def map_download_jobs(jobs, args):
+    """Runs download_job for jobs in order, args.workers at a time. Returns their results."""
+    if args.workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=min(args.workers, len(jobs))) as executor:
+            return list(executor.map(lambda job: download_job(job, args), jobs))
+    return [download_job(job, args) for job in jobs]
+
+def run_download_jobs(jobs, args):
+    """Downloads jobs in order, args.workers at a time. Returns the result of each job (True or False).
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = soup.find_all('a')
+    With --leases, files another worker holds are put back at the end of the run and tried again
+    every few seconds, until that worker finishes them (they are then found on disk), gives them up,
+    or stops refreshing its lease and it is reclaimed (after --lease-ttl).
+    """
+    results = map_download_jobs(jobs, args)
+    waiting = [position for position, result in enumerate(results) if result is None]
+    for position in waiting:
+        logging.info(f"Deferring {jobs[position].name} - leased by another worker.")
+        metrics.add('files_total', result='leased_elsewhere')
+    while waiting:
+        logging.info(f"Waiting for {len(waiting)} files leased by other workers...")
+        time.sleep(min(LEASE_POLL_SECONDS, _lease_manager.ttl / 3))
+        retried = map_download_jobs([jobs[position] for position in waiting], args)
+        for position, result in zip(waiting, retried):
+            results[position] = result
+        waiting = [position for position in waiting if results[position] is None]
+    return results
 
-    files_processed_count = 0
-    files_skipped_count = 0
-    subdirs_processed = []
+# --- Planning (Directory Crawl) ---
+class CrawlNode:
+    """A directory visited by the crawl: its jobs and crawled subdirectories, for the --sync completeness marks."""
+
+    def __init__(self, url, data_type, parent=None):
+        self.url = url
+        self.data_type = data_type
+        self.parent = parent
+        self.jobs = []
+        self.children = []
+        self.listed = False # Listing fetched successfully
+        self.unchanged = False # File selection skipped by --sync: unchanged and complete since an earlier run
+
+def plan_directory(current_url, current_output_path, data_type_name, args, target_coins, listings=None):
+    """Lists one directory and selects its files. Returns (jobs, subdirectories, skipped, unchanged).
+
+    subdirectories is a list of (url, output_path) pairs to crawl next; skipped counts files and
+    directories filtered out. unchanged is True when --sync finds the listing unchanged and
+    complete: its files are not selected again, but its subdirectories still are returned, since a
+    listing does not change when files are added further down. Listing errors are raised as
+    requests exceptions. listings is what the listing is fetched with (default: the shared ones).
+    """
+    listings = listings or get_shared_listings()
+    logging.info(f"Processing directory: {current_url}")
+    links, listing_changed = fetch_listing(current_url, listings)
 
-    # --- Process Files (.csv.gz) at Current Level ---
-    csv_links = [link for link in links if link.get('href') and link.get('href').lower().endswith('.csv.gz')]
+    # --- Incremental Sync ---
+    # An unchanged listing that an earlier run walked completely (with the same filters) has no new files at this level
+    unchanged = args.sync and not listing_changed and listings.cache.is_complete(current_url, get_sync_key(data_type_name, args, target_coins))
+    if unchanged:
+        logging.info(f"Skipping files of {current_url} - listing unchanged since the last complete sync; revalidating its subdirectories.")
+
+    jobs = []
+    skipped = 0
+
+    # --- Select Files (.csv.gz) at Current Level ---
+    start_date, end_date = get_date_window(args)
+    csv_links = [] if unchanged else [(href, text, size) for href, text, size in links if href.lower().endswith('.csv.gz')]
     if csv_links:
         logging.info(f"Found {len(csv_links)} potential .csv.gz files in {current_url}.")
         # Take first 3 files to analyze the name format
-        sample_files = [csv_link.text for csv_link in csv_links[:3]]
+        sample_files = [text for _, text, _ in csv_links[:3]]
         logging.info(f"Sample filenames: {', '.join(sample_files)}")
-        
-        for csv_link in csv_links:
-            csv_name = csv_link.text
-            # --- Extract Date ---
-            # TODO: Improve robustness for different formats (e.g., monthly: YYYY-MM)
-            date_match = re.search(r'(\d{4}-\d{2}-\d{2})', csv_name)
-            if not date_match:
-                # Attempt to find year-month if daily fails (basic pattern)
-                date_match_monthly = re.search(r'(\d{4}-\d{2})', csv_name)
-                if date_match_monthly:
-                    # For monthly files, treat as the first day for filtering purposes
-                    csv_date = date_match_monthly.group(1) + '-01'
-                    logging.debug(f"Extracted monthly date {date_match_monthly.group(1)} from '{csv_name}', using {csv_date} for filtering.")
-                else:
-                    logging.warning(f"Could not extract recognizable date (YYYY-MM-DD or YYYY-MM) from '{csv_name}'. Skipping.")
-                    files_skipped_count += 1
-                    continue
-            else:
-                csv_date = date_match.group(1)
+
+        for csv_href, _, csv_size in csv_links:
+            # --- Parse File Name ---
+            # Taken from the href: index pages shorten long link texts (nginx autoindex cuts them at 50 characters)
+            csv_name = os.path.basename(unquote(csv_href))
+            file_info = parse_filename(csv_name)
+            if file_info is None:
+                logging.warning(f"Could not extract a recognizable symbol and date from '{csv_name}'. Skipping.")
+                skipped += 1
+                continue
+            csv_date = file_info.start.isoformat()
 
             # --- Date Filtering ---
-            if csv_date < args.start_date:
-                logging.info(f"Skipping {csv_name} - date {csv_date} is before start date {args.start_date}")
-                files_skipped_count += 1
+            # Monthly (spot) and ranged (kline) files are kept whenever their period overlaps the window
+            if file_info.end < start_date:
+                logging.debug(f"Skipping {csv_name} - period ending {file_info.end} is before start date {args.start_date}")
+                skipped += 1
                 continue
-            if args.end_date and csv_date > args.end_date:
-                # We need to be careful with monthly files and end_date.
-                # If end_date is 2023-05-15, we should still potentially include 2023-05 monthly file.
-                # Let's refine this: Only skip if the file's *start* date (csv_date) is strictly *after* the end_date.
-                if csv_date > args.end_date:
-                     logging.info(f"Skipping {csv_name} - date {csv_date} is after end date {args.end_date}")
-                     files_skipped_count += 1
-                     continue
-
-            # --- Coin Filtering (Basic - from filename) ---
-            # TODO: Enhance coin extraction and filtering based on path components as well.
-            # This basic check assumes coin is at the start or follows a pattern.
-            file_coin = None
-            # Improved patterns for coin name identification
-            # For files in format BTCUSDT2023-12-31.csv.gz
-            match_coin = re.match(r'^([A-Z0-9]+)(?=\d{4}-\d{2}-\d{2})', csv_name)
-            if match_coin:
-                file_coin = match_coin.group(1)
-            else:
-                # Try to extract coin name from path when file is in a coin folder
-                # For example, in structure: /trading/BTCUSDT/...
-                coin_from_path = os.path.basename(os.path.dirname(current_url.rstrip('/')))
-                if coin_from_path and coin_from_path.upper() != 'TRADING' and coin_from_path.upper() != 'SPOT':
-                    file_coin = coin_from_path.upper()
-                    logging.info(f"Using coin name from path: {file_coin} for file {csv_name}")
-
-            if file_coin and 'ALL' not in target_coins and file_coin not in target_coins:
-                logging.info(f"Skipping {csv_name} - coin {file_coin} (from filename) not in target list.")
-                files_skipped_count += 1
+            if end_date and file_info.start > end_date:
+                logging.debug(f"Skipping {csv_name} - period starting {csv_date} is after end date {args.end_date}")
+                skipped += 1
+                continue
+
+            # --- Coin Filtering ---
+            file_coin = file_info.symbol
+            if 'ALL' not in target_coins and file_coin not in target_coins:
+                logging.debug(f"Skipping {csv_name} - coin {file_coin} (from filename) not in target list.")
+                skipped += 1
+                continue
+
+            # --- Shard Filtering ---
+            if not in_shard(args.shard, data_type_name, file_coin, csv_date):
+                logging.debug(f"Skipping {csv_name} - belongs to another shard.")
                 continue
-            elif not file_coin:
-                logging.debug(f"Could not reliably determine coin from filename '{csv_name}'. Proceeding without filename-based coin filtering.")
-
-            # --- File Handling ---
-            csv_url = f"{current_url.rstrip('/')}/{csv_link.get('href')}"
-            extracted_filename = csv_name[:-3] # Remove .gz
-            # Ensure the output path exists (it should normally, but safety first)
-            os.makedirs(current_output_path, exist_ok=True)
-            extracted_path = os.path.join(current_output_path, extracted_filename)
+
+            csv_url = f"{current_url.rstrip('/')}/{csv_href}"
+            extracted_path = os.path.join(current_output_path, csv_name[:-3]) # Remove .gz
             archive_path = os.path.join(current_output_path, csv_name)
+            jobs.append(DownloadJob(data_type_name, csv_name, csv_date, csv_url, archive_path, extracted_path, file_coin, csv_size))
+
+    # --- Select Subdirectories ---
+    subdirectories = []
+    for subdir_href in [href for href, _, _ in links if href.endswith('/') and href != '../']:
+        subdir_name = subdir_href[:-1] # Remove trailing slash
+
+        # --- Heuristic for Subdirectory Type --- #
+        # TODO: Make this logic more robust, potentially data_type specific config
+        # Simple check: If the subdir name matches a pattern of typical coin pairs (e.g., uppercase letters + USDT/USD/BTC etc.)
+        # and we are in specific data_type dirs known to have coin subdirs.
+        is_coin_dir = data_type_name in ['spot', 'kline_for_metatrader4', 'premium_index', 'spot_index'] and SYMBOL_PATTERN.fullmatch(subdir_name) and not YEAR_PATTERN.fullmatch(subdir_name)
+
+        if is_coin_dir and 'ALL' not in target_coins and subdir_name.upper() not in target_coins:
+            logging.debug(f"Skipping directory {subdir_name} - coin not in target list: {target_coins}")
+            skipped += 1
+            continue
+
+        # Year directories (e.g. kline_for_metatrader4/BTCUSDT/2020/) outside the window are not listed at all
+        if not year_in_range(subdir_name, start_date, end_date):
+            logging.info(f"Skipping directory {subdir_name} - year outside {args.start_date}..{args.end_date or 'now'}")
+            skipped += 1
+            continue
+
+        subdirectories.append((f"{current_url.rstrip('/')}/{subdir_href}", os.path.join(current_output_path, subdir_name)))
+
+    return jobs, subdirectories, skipped, unchanged
+
+def crawl_plan(roots, args, target_coins, listings=None):
+    """Crawls the listing trees under roots concurrently (args.crawl_workers listings at a time).
 
-            logging.info(f"Downloading file: {csv_name}, date: {csv_date}")
-            if download_and_extract(csv_url, archive_path, extracted_path):
-                files_processed_count += 1
-                logging.info(f"Successfully processed file: {csv_name}")
-            else:
-                 files_skipped_count += 1 # Failed download/extract
-                 logging.warning(f"Failed to download or extract file: {csv_name}")
-
-    # --- Process Subdirectories (Recursion) ---
-    subdir_links = [link for link in links if link.get('href') and link.get('href').endswith('/') and link.get('href') != '../']
-    if subdir_links:
-        logging.debug(f"Found {len(subdir_links)} subdirectories in {current_url}.")
-        for subdir_link in subdir_links:
-            subdir_name = subdir_link.get('href')[:-1] # Remove trailing slash
-            next_url = f"{current_url.rstrip('/')}/{subdir_link.get('href')}"
-            next_output_path = os.path.join(current_output_path, subdir_name)
-
-            # --- Heuristic for Subdirectory Type --- #
-            # TODO: Make this logic more robust, potentially data_type specific config
-            is_coin_dir = False
-            looks_like_year = bool(re.fullmatch(r'\d{4}', subdir_name))
-
-            # Simple check: If the subdir name matches a pattern of typical coin pairs (e.g., uppercase letters + USDT/USD/BTC etc.)
-            # and we are in specific data_type dirs known to have coin subdirs.
-            if data_type_name in ['spot', 'kline_for_metatrader4', 'premium_index', 'spot_index'] and re.fullmatch(r'[A-Z0-9]+', subdir_name):
-                 is_coin_dir = True
-                 logging.debug(f"Directory '{subdir_name}' looks like a coin directory for data type '{data_type_name}'.")
-
-            # --- Filtering & Recursion Decision ---
-            should_recurse = True
-            if is_coin_dir:
-                coin_name_from_dir = subdir_name.upper()
-                if 'ALL' not in target_coins and coin_name_from_dir not in target_coins:
-                    logging.info(f"Skipping directory {subdir_name} - coin not in target list: {target_coins}")
-                    should_recurse = False
-
-            # Add year filtering later if needed
-            # if looks_like_year:
-            #    # Compare year from subdir_name with start/end date args
-
-            if should_recurse:
-                # Ensure output directory for the next level exists BEFORE recursing
-                os.makedirs(next_output_path, exist_ok=True)
-                subdir_files_processed, subdir_files_skipped = process_directory(next_url, next_output_path, data_type_name, args, target_coins)
-                files_processed_count += subdir_files_processed
-                files_skipped_count += subdir_files_skipped
-                subdirs_processed.append(subdir_name)
-            else:
-                 files_skipped_count += 1 # Count skipped directory as one skip for summary
-
-    log_suffix = f" files processed: {files_processed_count}, files skipped/errors: {files_skipped_count}"
-    if subdirs_processed:
-        log_suffix += f", subdirs processed: {len(subdirs_processed)} ({', '.join(subdirs_processed[:3])}{'...' if len(subdirs_processed)>3 else ''})"
-
-    logging.info(f"Finished processing {current_url}. Totals for this level and below ->{log_suffix}")
-    return files_processed_count, files_skipped_count # Return counts for aggregation
+    roots is a list of (url, output_path, data_type, coin) tuples; coin is set when the root is a
+    directly requested coin directory, so a 404 is reported as a missing coin. Returns
+    (jobs, nodes, skipped), where nodes maps each crawled URL to its CrawlNode. Listings are
+    fetched with listings (default: the shared ones).
+    """
+    jobs = []
+    nodes = {}
+    skipped = 0
+    pending = {}
+    with ThreadPoolExecutor(max_workers=args.crawl_workers) as executor:
+        def submit(url, output_path, data_type_name, parent=None, coin=None):
+            nodes[url] = CrawlNode(url, data_type_name, parent)
+            if parent is not None:
+                nodes[parent].children.append(url)
+            future = executor.submit(plan_directory, url, output_path, data_type_name, args, target_coins, listings)
+            pending[future] = (url, coin)
+
+        for url, output_path, data_type_name, coin in roots:
+            submit(url, output_path, data_type_name, coin=coin)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, coin = pending.pop(future)
+                node = nodes[url]
+                try:
+                    result = future.result()
+                except requests.exceptions.HTTPError as e:
+                    if coin and e.response is not None and e.response.status_code == 404:
+                        logging.warning(f"Coin {coin} not found for data type {node.data_type} (URL: {url})")
+                    else:
+                        logging.error(f"Error fetching directory URL {url}: {e}")
+                    skipped += 1
+                    continue
+                except requests.exceptions.RequestException as e:
+                    logging.error(f"Error fetching directory URL {url}: {e}")
+                    skipped += 1
+                    continue
+                node.listed = True
+                directory_jobs, subdirectories, directory_skipped, node.unchanged = result
+                node.jobs = directory_jobs
+                jobs.extend(directory_jobs)
+                skipped += directory_skipped
+                for subdir_url, subdir_path in subdirectories:
+                    submit(subdir_url, subdir_path, node.data_type, parent=url)
+    return jobs, nodes, skipped
+
+def mark_complete_directories(nodes, results, args, target_coins):
+    """Records which crawled directories were completely handled, for --sync.
+
+    A directory is complete when its listing was fetched, all of its jobs succeeded, and all of the
+    subdirectories it led to are complete. An unchanged directory has no jobs of its own, so it
+    stays complete exactly when its subdirectories are. Children are marked before their parents.
+    """
+    for url in sorted(nodes, key=len, reverse=True):
+        node = nodes[url]
+        sync_key = get_sync_key(node.data_type, args, target_coins)
+        complete = (node.listed
+                    and all(results.get(job) for job in node.jobs)
+                    and all(_listing_cache.is_complete(child, sync_key) for child in node.children))
+        _listing_cache.set_complete(url, sync_key if complete else None)
+
+def print_plan(jobs):
+    """Prints a plan (one line per file) and its size summary to stdout."""
+    for job in jobs:
+        size = format_size(job.size) if job.size is not None else 'unknown size'
+        print(f"{job.date}  {job.data_type}/{job.symbol}  {job.name}  ({size})  {job.url}")
+    for line in format_plan_summary(jobs):
+        print(line)
+
+def log_run_totals(jobs, results):
+    """Logs processed and failed files per data type."""
+    for data_type_name in sorted({job.data_type for job in jobs}):
+        selected = [results[job] for job in jobs if job.data_type == data_type_name]
+        processed = sum(1 for ok in selected if ok)
+        failed = len(selected) - processed
+        logging.info(f"--- Finished processing data type: {data_type_name}. Total files processed/verified: {processed}, total errors: {failed} ---")
 
 # --- Main Download Logic ---
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        module_name, function_name = SUBCOMMANDS[sys.argv[1]]
+        module = importlib.import_module(module_name, __package__)
+        return getattr(module, function_name)(sys.argv[2:])
+
     args, target_coins, target_data_types = parse_arguments()
 
     # Create the main output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
 
-    # --- Initial Request to List Data Types ---
-    logging.info(f"Fetching available data types from {args.base_url}...")
+    # One keep-alive connection per worker, shared by listings and downloads
+    concurrency = max(args.workers, args.crawl_workers)
+    configure_session(concurrency)
+    configure_rate_controller(args.max_rate, concurrency, args.max_attempts)
+    # Shards walk different subsets of the tree, so each keeps its own listing cache (and --sync marks)
+    cache_filename = LISTING_CACHE_FILENAME
+    if args.shard:
+        cache_filename = cache_filename.replace('.json', f".shard-{args.shard[0] + 1}-of-{args.shard[1]}.json")
+    configure_listing_cache(os.path.join(args.output_dir, cache_filename))
+    if args.leases:
+        configure_leases(args.output_dir, args.lease_ttl)
+    if not args.no_catalog:
+        configure_catalog(args.output_dir)
+    configure_time_index(args.index_rows, args.index_seconds, enabled=not args.no_time_index)
+
+    exporter = None
+    if args.metrics_file and args.metrics_interval > 0:
+        exporter = metrics.PeriodicExporter(args.metrics_file, args.metrics_interval).start()
     try:
-        response = requests.get(args.base_url)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching base URL {args.base_url}: {e}")
-        sys.exit(1)
+        download_data_types(args, target_coins, target_data_types)
+    finally:
+        if _lease_manager is not None:
+            _lease_manager.stop()
+        if _catalog is not None:
+            _catalog.close()
+        log_metrics_summary()
+        if exporter is not None:
+            exporter.stop()
+        elif args.metrics_file:
+            metrics.get_metrics().write(args.metrics_file)
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = soup.find_all('a')
+def log_metrics_summary():
+    """Logs the time and bytes spent in each stage of the run."""
+    logging.info("--- Stage Metrics ---")
+    for line in metrics.get_metrics().format_summary():
+        logging.info(line)
+    results = ', '.join(f"{result}: {metrics.get_metrics().get('files_total', result=result)}" for result in ('downloaded', 'skipped', 'failed', 'convert_failed', 'leased_elsewhere'))
+    logging.info(f"Files - {results}")
+
+def get_crawl_roots(args, target_coins, target_data_types, listings=None):
+    """Returns the (url, output_path, data_type, coin) directories the crawl starts from.
+
+    Raises a requests exception if the base listing cannot be fetched.
+    """
+    # --- Initial Request to List Data Types ---
+    logging.info(f"Fetching available data types from {args.base_url}...")
+    links, _ = fetch_listing(args.base_url, listings) # Raises HTTPError for bad responses (4xx or 5xx)
 
-    # --- Loop Through Data Types ---
     available_data_types_on_server = []
-    for link in links:
-        href = link.get('href')
-        if href and href.endswith('/') and href != '../':
+    for href, _, _ in links:
+        if href.endswith('/') and href != '../':
             available_data_types_on_server.append(href[:-1])
 
     logging.info(f"Found data type directories on server: {', '.join(available_data_types_on_server)}")
 
+    roots = []
     for data_type_name in target_data_types:
         if data_type_name not in available_data_types_on_server:
              logging.warning(f"Requested data type '{data_type_name}' not found directly under {args.base_url}. Skipping.")
              continue
+        data_type_url = f"{args.base_url.rstrip('/')}/{data_type_name}/" # Ensure trailing slash
+        data_type_dir = os.path.join(args.output_dir, data_type_name)
+        if 'ALL' in target_coins:
+            roots.append((data_type_url, data_type_dir, data_type_name, None))
+        else:
+            # Directly access requested coins instead of scanning all
+            for coin in target_coins:
+                roots.append((f"{data_type_url}{coin}/", os.path.join(data_type_dir, coin), data_type_name, coin))
+    return roots
 
-        logging.info(f"\n--- Processing Data Type: {data_type_name} ---")
+def plan_downloads(data_types, coins, start_date, end_date=None, base_url=DEFAULT_BASE_URL, crawl_workers=DEFAULT_CRAWL_WORKERS, shard=None,
+                   max_rate=DEFAULT_MAX_RATE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Crawls the listings like a download run and returns the selected DownloadJobs, oldest first.
 
-        # Create the subdirectory for this data type
-        data_type_dir = os.path.join(args.output_dir, data_type_name)
-        os.makedirs(data_type_dir, exist_ok=True)
+    Library counterpart of phase 1 (nothing is written to disk): data_types and coins are lists of
+    names (coins may be ['ALL']), dates are 'YYYY-MM-DD' strings. Raises a requests exception if
+    the base listing cannot be fetched; unreachable subdirectories are logged and skipped. Every
+    call lists the server afresh (listings are not remembered between calls), through a Session
+    and RateController of its own sized for crawl_workers listings at a time.
+    """
+    args = argparse.Namespace(base_url=base_url, output_dir='', start_date=start_date, end_date=end_date,
+                              sync=False, shard=shard, crawl_workers=crawl_workers, output_format='csv')
+    target_coins = ['ALL'] if 'ALL' in coins else [coin.upper() for coin in coins]
+    with create_session(crawl_workers) as session:
+        listings = Listings(ListingCache(), session, RateController(max_rate, crawl_workers, max_attempts))
+        roots = get_crawl_roots(args, target_coins, data_types, listings)
+        jobs, _, _ = crawl_plan(roots, args, target_coins, listings)
+    return order_jobs(jobs, 'date')
 
-        # If not ALL, directly access requested coins instead of scanning all
-        if 'ALL' not in target_coins:
-            total_processed = 0
-            total_skipped = 0
-            
-            for coin in target_coins:
-                logging.info(f"Directly accessing coin: {coin} for data type: {data_type_name}")
-                # Construct URL for specific coin
-                coin_url = f"{args.base_url.rstrip('/')}/{data_type_name}/{coin}/"
-                coin_dir = os.path.join(data_type_dir, coin)
-                os.makedirs(coin_dir, exist_ok=True)
-                
-                try:
-                    # First check if this coin exists on the server
-                    response = requests.head(coin_url)
-                    if response.status_code == 200:
-                        # If coin exists, process it
-                        coin_processed, coin_skipped = process_directory(coin_url, coin_dir, data_type_name, args, target_coins)
-                        total_processed += coin_processed
-                        total_skipped += coin_skipped
-                    else:
-                        logging.warning(f"Coin {coin} not found for data type {data_type_name} (URL: {coin_url})")
-                        total_skipped += 1
-                except requests.exceptions.RequestException as e:
-                    logging.error(f"Error checking coin URL {coin_url}: {e}")
-                    total_skipped += 1
-            
-            logging.info(f"--- Finished processing data type: {data_type_name}. Total files processed/verified: {total_processed}, total skipped/errors: {total_skipped} ---")
-        else:
-            # If all coins requested, use existing directory scanning logic
-            dir_url = f"{args.base_url.rstrip('/')}/{data_type_name}/" # Ensure trailing slash
-            total_processed, total_skipped = process_directory(dir_url, data_type_dir, data_type_name, args, target_coins)
-            logging.info(f"--- Finished processing data type: {data_type_name}. Total files processed/verified: {total_processed}, total skipped/errors: {total_skipped} ---")
+def download_data_types(args, target_coins, target_data_types):
+    """Plans and downloads every requested data type from args.base_url (or runs a saved plan).
+
+    Phase 1 crawls the listings concurrently into a plan of DownloadJobs, phase 2 downloads them.
+    """
+    nodes = None
+    if args.from_plan:
+        try:
+            jobs, meta = load_plan(args.from_plan, args.output_dir)
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.error(f"Could not read plan {args.from_plan}: {e}")
+            sys.exit(1)
+        jobs = [job for job in jobs if in_shard(args.shard, job.data_type, job.symbol, job.date)]
+        logging.info(f"Loaded {len(jobs)} jobs from {args.from_plan} (planned from {meta.get('base_url', 'unknown')})")
+    else:
+        # --- Phase 1: Plan ---
+        try:
+            roots = get_crawl_roots(args, target_coins, target_data_types)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error fetching base URL {args.base_url}: {e}")
+            sys.exit(1)
+        started = time.perf_counter()
+        jobs, nodes, skipped = crawl_plan(roots, args, target_coins)
+        # Persist the listing cache right away, so an interrupted run keeps what it learned
+        _listing_cache.save()
+        logging.info(f"Planned {len(jobs)} files from {len(nodes)} directories in {time.perf_counter() - started:.1f}s ({skipped} files/directories filtered out or failed to list)")
+        if args.plan_file:
+            meta = {'base_url': args.base_url, 'start_date': args.start_date, 'end_date': args.end_date,
+                    'coins': target_coins, 'data_types': target_data_types}
+            save_plan(args.plan_file, order_jobs(jobs, args.order), args.output_dir, meta)
+            logging.info(f"Saved plan to {args.plan_file}")
+
+    jobs = order_jobs(jobs, args.order)
+    cataloged = []
+    if _catalog is not None and not args.recheck:
+        # One query instead of checking each file on disk
+        jobs, cataloged = _catalog.filter_jobs(jobs, args.output_format)
+        if cataloged:
+            logging.info(f"Skipping {len(cataloged)} files already recorded in the catalog (use --recheck to check them on disk).")
+            metrics.add('files_total', len(cataloged), result='skipped')
+    for line in format_plan_summary(jobs):
+        logging.info(f"Plan: {line}")
+    if args.dry_run:
+        print_plan(jobs)
+        return
+
+    # --- Phase 2: Download ---
+    results = dict(zip(jobs, run_download_jobs(jobs, args)))
+    results.update((job, True) for job in cataloged)
+    jobs += cataloged
+    log_run_totals(jobs, results)
+    if nodes is not None:
+        mark_complete_directories(nodes, results, args, target_coins)
+        _listing_cache.save()
 
 
 # Wrap the script execution in a main function call
@@ -0,0 +1,314 @@
+"""
+Catalog of downloaded files: a SQLite database in the output directory, kept up to date by the downloader.
+
+Every file is recorded once it is completely extracted (and converted), with its source URL,
+archive size, ETag, row count, first/last timestamps and the CRC32 of its CSV content. The
+downloader uses the catalog to drop already downloaded files from a plan in one query instead of
+checking the disk file by file; the `status` and `gaps` subcommands answer coverage questions from
+it without walking the output directory.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import date, timedelta
+
+from .blockgz import get_timestamp_parser
+from .filenames import parse_filename
+from .planner import format_size
+
+CATALOG_FILENAME = '.catalog.sqlite'
+
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,   -- Output file, relative to the output directory
+    data_type TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,      -- First day the file covers (ISO date)
+    end_date TEXT NOT NULL,  -- Last day the file covers
+    name TEXT NOT NULL,      -- Archive name on the server
+    format TEXT NOT NULL,    -- Output format (csv, parquet, npy, bgzip)
+    url TEXT,
+    size INTEGER,            -- Archive size in bytes
+    etag TEXT,
+    rows INTEGER,
+    min_ts INTEGER,          -- Nanoseconds since the epoch
+    max_ts INTEGER,
+    checksum TEXT,           -- CRC32 of the extracted CSV (the gzip trailer CRC of the archive)
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_coverage ON files (data_type, symbol, date);
+CREATE INDEX IF NOT EXISTS files_url ON files (url);
+"""
+
+# Bytes kept from the start and the end of a CSV to find its first and last rows
+HEAD_BYTES = 64 * 1024
+TAIL_BYTES = 64 * 1024
+
+class FileStats:
+    """Statistics of one file gathered while it is extracted: CSV rows, CRC32 and first/last timestamps.
+
+    feed() receives the decompressed bytes in order; the downloader fills in size and etag from the
+    archive. Bybit files are time-ordered, so the first and last rows hold the smallest and largest
+    timestamps (in either order).
+    """
+
+    def __init__(self, data_type):
+        self.data_type = data_type
+        self.size = None
+        self.etag = None
+        self.reset()
+
+    def reset(self):
+        """Forgets fed data (a retried download starts over)."""
+        self.complete = False
+        self.crc = 0
+        self.bytes = 0
+        self.newlines = 0
+        self.head = b''
+        self.tail = b''
+
+    def feed(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.bytes += len(data)
+        self.newlines += data.count(b'\n')
+        if len(self.head) < HEAD_BYTES and self.head.count(b'\n') < 2:
+            self.head += data[:HEAD_BYTES]
+        self.tail = data[-TAIL_BYTES:] if len(data) >= TAIL_BYTES else (self.tail + data)[-TAIL_BYTES:]
+        self.complete = True
+
+    def get_summary(self):
+        """Returns (rows, min_ts, max_ts, checksum); timestamps are None if the data type has no timestamp column."""
+        lines = self.head.split(b'\n')
+        first_line = lines[0].decode('utf-8', 'replace').rstrip('\r')
+        has_header = bool(first_line) and not first_line[:1].isdigit()
+        rows = self.newlines - (1 if has_header else 0)
+        if self.bytes and not self.tail.endswith(b'\n'):
+            rows += 1 # Last line without a trailing newline
+        min_ts = max_ts = None
+        if has_header and rows > 0 and len(lines) > 1:
+            position, converter = get_timestamp_parser(self.data_type, first_line.split(','))
+            last_line = self.tail.rstrip(b'\r\n').rsplit(b'\n', 1)[-1]
+            if position is not None:
+                try:
+                    timestamps = converter([line.decode('utf-8').rstrip('\r').split(',')[position] for line in (lines[1], last_line)])
+                    min_ts, max_ts = min(timestamps), max(timestamps)
+                except (IndexError, ValueError, UnicodeDecodeError):
+                    pass
+        return max(rows, 0), min_ts, max_ts, f"{self.crc:08x}"
+
+class Catalog:
+    """The catalog database of an output directory. Thread-safe; several processes may share it."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, CATALOG_FILENAME)
+        self.lock = threading.Lock()
+        # Concurrent writers (other processes on the same output directory) wait up to timeout seconds
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(SCHEMA)
+            self.connection.execute(f'PRAGMA user_version={CATALOG_VERSION}')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(self, job, path, output_format, stats=None):
+        """Records the output file of a finished job (a DownloadJob).
+
+        Without stats (a file found on disk rather than downloaded) an existing entry is kept as it is.
+        """
+        file_info = parse_filename(job.name)
+        end_date = file_info.end.isoformat() if file_info else job.date
+        relative_path = os.path.relpath(path, self.output_dir)
+        if stats is not None and stats.complete:
+            rows, min_ts, max_ts, checksum = stats.get_summary()
+            size, etag, verb = stats.size, stats.etag, 'INSERT OR REPLACE'
+        else:
+            rows = min_ts = max_ts = checksum = etag = None
+            size, verb = job.size, 'INSERT OR IGNORE'
+        with self.lock, self.connection:
+            self.connection.execute(
+                f'{verb} INTO files (path, data_type, symbol, date, end_date, name, format, url, size, etag, rows, min_ts, max_ts, checksum, recorded)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (relative_path, job.data_type, job.symbol, job.date, end_date, job.name, output_format, job.url,
+                 size, etag, rows, min_ts, max_ts, checksum, time.time()))
+
+    def remove(self, path):
+        """Forgets the entry of an output file that no longer exists."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files WHERE path = ?', (os.path.relpath(path, self.output_dir),))
+
+    def get_sizes(self, data_types, output_format):
+        """Returns {url: archive size (or None)} for every cataloged file of data_types in output_format."""
+        placeholders = ','.join('?' * len(data_types))
+        with self.lock:
+            cursor = self.connection.execute(
+                f'SELECT url, size FROM files WHERE format = ? AND data_type IN ({placeholders})',
+                [output_format] + list(data_types))
+            return dict(cursor.fetchall())
+
+    def filter_jobs(self, jobs, output_format):
+        """Splits jobs into (to_download, cataloged): a job is cataloged if its URL was downloaded in output_format.
+
+        The disk is not checked. A cataloged file whose size on the server changed since is logged but
+        still counted as cataloged.
+        """
+        if not jobs:
+            return [], []
+        sizes = self.get_sizes(sorted({job.data_type for job in jobs}), output_format)
+        to_download = []
+        cataloged = []
+        for job in jobs:
+            if job.url not in sizes:
+                to_download.append(job)
+                continue
+            size = sizes[job.url]
+            if job.size is not None and size is not None and job.size != size:
+                logging.warning(f"{job.name} changed on the server since it was downloaded ({size} -> {job.size} bytes); delete the local file and run with --recheck to download it again.")
+            cataloged.append(job)
+        return to_download, cataloged
+
+    def get_symbols(self, data_type=None):
+        """Returns the sorted (data_type, symbol) pairs in the catalog."""
+        query = 'SELECT DISTINCT data_type, symbol FROM files'
+        params = []
+        if data_type:
+            query += ' WHERE data_type = ?'
+            params.append(data_type)
+        with self.lock:
+            return sorted(self.connection.execute(query, params).fetchall())
+
+    def get_periods(self, data_type, symbol):
+        """Returns the (first day, last day) periods covered by symbol's files as date tuples, in order."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT date, end_date FROM files WHERE data_type = ? AND symbol = ? ORDER BY date',
+                (data_type, symbol)).fetchall()
+        return [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in rows]
+
+    def get_status(self, data_type, symbol):
+        """Returns a dict summarizing symbol's cataloged files (each file counted once, whatever its formats)."""
+        with self.lock:
+            files, first, last, size, rows = self.connection.execute(
+                'SELECT COUNT(*), MIN(date), MAX(end_date), SUM(size), SUM(rows) FROM'
+                ' (SELECT MIN(date) AS date, MAX(end_date) AS end_date, MAX(size) AS size, MAX(rows) AS rows'
+                '  FROM files WHERE data_type = ? AND symbol = ? GROUP BY name)',
+                (data_type, symbol)).fetchone()
+            formats = [row[0] for row in self.connection.execute(
+                'SELECT DISTINCT format FROM files WHERE data_type = ? AND symbol = ? ORDER BY format', (data_type, symbol))]
+        periods = self.get_periods(data_type, symbol)
+        missing = sum((end - start).days + 1 for start, end in find_gaps(periods))
+        return {
+            'data_type': data_type, 'symbol': symbol, 'files': files, 'first_date': first, 'last_date': last,
+            'missing_days': missing, 'archive_bytes': size or 0, 'rows': rows or 0,
+            'formats': formats,
+        }
+
+def find_gaps(periods, start=None, end=None):
+    """Returns the (first day, last day) ranges within [start, end] not covered by periods (sorted by start).
+
+    start and end default to the first and last covered day.
+    """
+    if not periods and (start is None or end is None):
+        return []
+    start = start or periods[0][0]
+    end = end or max(period_end for _, period_end in periods)
+    gaps = []
+    next_day = start # First day not known to be covered
+    for period_start, period_end in periods:
+        if period_start > end:
+            break
+        if period_start > next_day:
+            gaps.append((next_day, period_start - timedelta(days=1)))
+        next_day = max(next_day, period_end + timedelta(days=1))
+    if next_day <= end:
+        gaps.append((next_day, end))
+    return gaps
+
+def open_catalog(output_dir):
+    """Opens the catalog of output_dir for the subcommands; exits if there is none."""
+    if not os.path.exists(os.path.join(output_dir, CATALOG_FILENAME)):
+        logging.error(f"No catalog in {output_dir}. It is created by the downloader (see --no-catalog).")
+        sys.exit(1)
+    return Catalog(output_dir)
+
+def get_selected_symbols(catalog, data_types, coins):
+    """Returns the cataloged (data_type, symbol) pairs matching comma-separated data types and coins ('ALL' or None = all)."""
+    selected_types = None if not data_types or data_types.upper() == 'ALL' else {dt.strip().lower() for dt in data_types.split(',')}
+    selected_coins = None if not coins or coins.upper() == 'ALL' else {coin.strip().upper() for coin in coins.split(',')}
+    return [(data_type, symbol) for data_type, symbol in catalog.get_symbols()
+            if (selected_types is None or data_type in selected_types) and (selected_coins is None or symbol in selected_coins)]
+
+def status_main(argv=None):
+    """Entry point of the 'status' subcommand."""
+    parser = argparse.ArgumentParser(prog='start status', description='Summarize the files recorded in the catalog of an output directory')
+    parser.add_argument('--output-dir', default='./data', help='Directory the data was downloaded to (default: ./data)')
+    parser.add_argument('--data-types', help="Comma-separated list of data types (default: ALL)")
+    parser.add_argument('--coins', help="Comma-separated list of coin pairs (default: ALL)")
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    catalog = open_catalog(args.output_dir)
+    try:
+        statuses = [catalog.get_status(data_type, symbol) for data_type, symbol in get_selected_symbols(catalog, args.data_types, args.coins)]
+    finally:
+        catalog.close()
+    if args.json:
+        print(json.dumps(statuses, indent=2))
+        return
+    if not statuses:
+        print("No matching files in the catalog.")
+        return
+    print(f"{'data type':<22} {'symbol':<14} {'files':>7} {'first':<10}  {'last':<10} {'missing days':>12} {'rows':>14} {'archives':>10}  formats")
+    for status in statuses:
+        print(f"{status['data_type']:<22} {status['symbol']:<14} {status['files']:>7} {status['first_date']:<10}  {status['last_date']:<10}"
+              f" {status['missing_days']:>12} {status['rows']:>14} {format_size(status['archive_bytes']):>10}  {','.join(status['formats'])}")
+
+def gaps_main(argv=None):
+    """Entry point of the 'gaps' subcommand."""
+    parser = argparse.ArgumentParser(prog='start gaps', description='List the days missing from the downloaded files of each symbol')
+    parser.add_argument('--output-dir', default='./data', help='Directory the data was downloaded to (default: ./data)')
+    parser.add_argument('--data-types', default='trading', help="Comma-separated list of data types or 'ALL' (default: trading)")
+    parser.add_argument('--coins', help="Comma-separated list of coin pairs (default: ALL)")
+    parser.add_argument('--start-date', type=date.fromisoformat, help="First day to check (default: each symbol's first downloaded day)")
+    parser.add_argument('--end-date', type=date.fromisoformat, help="Last day to check (default: each symbol's last downloaded day)")
+    parser.add_argument('--json', action='store_true', help='Print the gaps as JSON')
+    args = parser.parse_args(argv)
+
+    catalog = open_catalog(args.output_dir)
+    try:
+        results = []
+        selected = get_selected_symbols(catalog, args.data_types, args.coins)
+        if args.coins and args.coins.upper() != 'ALL' and args.start_date and args.end_date:
+            # With an explicit window, a requested symbol without any file is one big gap
+            data_types = {data_type for data_type, _ in selected}
+            if args.data_types.upper() != 'ALL':
+                data_types |= {dt.strip().lower() for dt in args.data_types.split(',')}
+            requested = {(data_type, coin.strip().upper()) for data_type in data_types for coin in args.coins.split(',')}
+            selected = sorted(set(selected) | requested)
+        for data_type, symbol in selected:
+            gaps = find_gaps(catalog.get_periods(data_type, symbol), args.start_date, args.end_date)
+            results.append({'data_type': data_type, 'symbol': symbol, 'gaps': [[start.isoformat(), end.isoformat()] for start, end in gaps]})
+    finally:
+        catalog.close()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        days = sum((date.fromisoformat(end) - date.fromisoformat(start)).days + 1 for start, end in result['gaps'])
+        print(f"{result['data_type']}/{result['symbol']}: {len(result['gaps'])} gaps, {days} days missing")
+        for start, end in result['gaps']:
+            length = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+            print(f"  {start} .. {end}  ({length} day{'s' if length != 1 else ''})")
@@ -0,0 +1,345 @@
+"""
+Conversion of downloaded CSV files into typed columnar layouts: Parquet files or directories of NumPy .npy columns.
+"""
+
+import os
+import csv
+import json
+import shutil
+import calendar
+import logging
+
+from . import metrics
+from .optional import import_optional
+
+# 'bgzip' keeps the CSV compressed in indexed blocks (see blockgz.py); the others are converted here
+OUTPUT_FORMATS = ['csv', 'parquet', 'npy', 'bgzip']
+
+# Rows parsed and written per chunk; memory use is proportional to this, not to the file size
+CONVERT_CHUNK_ROWS = 100000
+
+# Column kinds:
+#   timestamp_s   seconds with a fractional part (e.g. 1585180700.0755), stored as int64 nanoseconds
+#   timestamp_ms  integer milliseconds, stored as int64 nanoseconds
+#   int64/float64 plain numbers
+#   category      dictionary-encoded strings (int32 codes + list of categories)
+#   string        free-form strings (e.g. trade IDs)
+#   timestamp_ns  int64 nanoseconds, not read from the file but derived (see DERIVED_TIMESTAMPS)
+# Columns found in a file but missing from its schema are kept as 'string'. Files without a header
+# row (the kline_for_metatrader4 exports) get the schema's column names by position.
+SCHEMAS = {
+    'trading': [
+        ('timestamp', 'timestamp_s'), ('symbol', 'category'), ('side', 'category'), ('size', 'float64'),
+        ('price', 'float64'), ('tickDirection', 'category'), ('trdMatchID', 'string'),
+        ('grossValue', 'float64'), ('homeNotional', 'float64'), ('foreignNotional', 'float64'),
+    ],
+    'spot': [
+        ('id', 'int64'), ('timestamp', 'timestamp_ms'), ('price', 'float64'), ('volume', 'float64'), ('side', 'category'),
+    ],
+    'kline_for_metatrader4': [
+        ('date', 'category'), ('time', 'category'), ('open', 'float64'), ('high', 'float64'),
+        ('low', 'float64'), ('close', 'float64'), ('volume', 'float64'),
+    ],
+    'premium_index': [
+        ('start_at', 'timestamp_s'), ('symbol', 'category'), ('period', 'category'), ('open', 'float64'),
+        ('high', 'float64'), ('low', 'float64'), ('close', 'float64'),
+    ],
+    'spot_index': [
+        ('start_at', 'timestamp_s'), ('symbol', 'category'), ('period', 'category'), ('open', 'float64'),
+        ('high', 'float64'), ('low', 'float64'), ('close', 'float64'),
+    ],
+}
+
+# Data types without a timestamp column: name -> (date column, time column) it is derived from.
+# The derived column is added after the file's own columns, as UTC.
+DERIVED_TIMESTAMPS = {
+    'kline_for_metatrader4': ('timestamp', 'date', 'time'),
+}
+
+# Extension used for each non-CSV format (the npy format is a directory of per-column files)
+FORMAT_EXTENSIONS = {'parquet': '.parquet', 'npy': '.columns', 'bgzip': '.csv.bgz'}
+
+# Size of the .npy header reserved up front, so the final row count can be filled in after streaming
+NPY_HEADER_SIZE = 128
+
+def get_output_path(csv_path, output_format):
+    """Returns where the converted form of csv_path is stored for output_format."""
+    if output_format == 'csv':
+        return csv_path
+    base = csv_path[:-4] if csv_path.endswith('.csv') else csv_path
+    return base + FORMAT_EXTENSIONS[output_format]
+
+def check_format_dependencies(output_format):
+    """Raises ImportError early if the libraries needed for output_format are not installed."""
+    if output_format in ('parquet', 'npy'):
+        import_optional('numpy')
+    if output_format == 'parquet':
+        import_optional('pyarrow.parquet')
+
+# --- Parsing ---
+def timestamp_s_to_ns(values):
+    """Converts decimal-second strings to integer nanoseconds without going through float (which loses ~µs)."""
+    result = []
+    for value in values:
+        if not value:
+            result.append(0)
+        elif 'e' in value or 'E' in value:
+            result.append(int(float(value) * 1e9))
+        else:
+            seconds, _, fraction = value.partition('.')
+            result.append(int(seconds) * 1000000000 + int((fraction + '000000000')[:9]))
+    return result
+
+def timestamp_ms_to_ns(values):
+    """Converts millisecond strings to integer nanoseconds."""
+    return [int(float(value)) * 1000000 if value else 0 for value in values]
+
+def date_time_to_ns(dates, times):
+    """Converts 'YYYY.MM.DD' dates and 'HH:MM[:SS]' times (UTC) to integer nanoseconds; malformed pairs become 0."""
+    days = {}
+    result = []
+    for date, time in zip(dates, times):
+        try:
+            day = days.get(date)
+            if day is None:
+                year, month, mday = date.replace('-', '.').split('.')
+                day = days[date] = calendar.timegm((int(year), int(month), int(mday), 0, 0, 0))
+            parts = time.split(':')
+            seconds = int(parts[0]) * 3600 + int(parts[1]) * 60 + (int(parts[2]) if len(parts) > 2 else 0)
+            result.append((day + seconds) * 1000000000)
+        except (ValueError, IndexError):
+            result.append(0)
+    return result
+
+def to_number_array(np, values, dtype):
+    """Converts strings to a numpy array, mapping empty or malformed values to NaN (floats) or 0 (ints)."""
+    try:
+        return np.array(values, dtype=dtype)
+    except ValueError:
+        cast = float if dtype == np.float64 else int
+        missing = float('nan') if dtype == np.float64 else 0
+        converted = []
+        for value in values:
+            try:
+                converted.append(cast(value))
+            except ValueError:
+                converted.append(missing)
+        return np.array(converted, dtype=dtype)
+
+def get_file_schema(data_type, first_row):
+    """Returns (columns, has_header) for a file, where columns is a list of (name, kind) in file order."""
+    schema = SCHEMAS.get(data_type, [])
+    # Data rows start with a number or a date; header rows start with a column name
+    has_header = not first_row[0][:1].isdigit()
+    if has_header:
+        kinds = dict(schema)
+        return [(name, kinds.get(name, 'string')) for name in first_row], True
+    columns = list(schema[:len(first_row)])
+    columns += [(f"column_{i}", 'string') for i in range(len(columns), len(first_row))]
+    return columns, False
+
+def iter_typed_chunks(csv_path, data_type, chunk_rows=CONVERT_CHUNK_ROWS):
+    """Reads a CSV file in chunks and yields (columns, chunk) with typed values; see iter_typed_row_chunks."""
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        yield from iter_typed_row_chunks(csv.reader(f), data_type, chunk_rows)
+
+def iter_typed_row_chunks(rows, data_type, chunk_rows=CONVERT_CHUNK_ROWS):
+    """Groups CSV rows (lists of strings, header first if the file has one) into typed chunks.
+
+    Yields (columns, chunk). columns is the list of (name, kind) for the file, followed by the
+    derived timestamp column for data types in DERIVED_TIMESTAMPS. chunk maps each column name to
+    a numpy array (int64 nanoseconds for timestamps, int32 codes for categories) or, for 'string'
+    columns, a list of str. Categories are yielded as chunk[name + '.categories'], the full list of
+    values seen so far in the file; codes index into it.
+    """
+    np = import_optional('numpy')
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+    file_columns, has_header = get_file_schema(data_type, first_row)
+    columns = file_columns
+    derived = DERIVED_TIMESTAMPS.get(data_type)
+    positions = {name: i for i, (name, _) in enumerate(file_columns)}
+    if derived and derived[0] not in positions and derived[1] in positions and derived[2] in positions:
+        columns = file_columns + [(derived[0], 'timestamp_ns')]
+    else:
+        derived = None
+    categories = {name: {} for name, kind in columns if kind == 'category'}
+    pending = [] if has_header else [first_row]
+    while True:
+        for row in rows:
+            if row:
+                pending.append(row)
+            if len(pending) >= chunk_rows:
+                break
+        if not pending:
+            return
+        fields = list(zip(*(row + [''] * (len(file_columns) - len(row)) for row in pending)))
+        pending = []
+        chunk = {}
+        for (name, kind), values in zip(file_columns, fields):
+            if kind == 'timestamp_s':
+                chunk[name] = np.array(timestamp_s_to_ns(values), dtype=np.int64)
+            elif kind == 'timestamp_ms':
+                chunk[name] = np.array(timestamp_ms_to_ns(values), dtype=np.int64)
+            elif kind == 'float64':
+                chunk[name] = to_number_array(np, values, np.float64)
+            elif kind == 'int64':
+                chunk[name] = to_number_array(np, values, np.int64)
+            elif kind == 'category':
+                index = categories[name]
+                chunk[name] = np.array([index.setdefault(value, len(index)) for value in values], dtype=np.int32)
+                chunk[name + '.categories'] = list(index)
+            else:
+                chunk[name] = list(values)
+        if derived:
+            name, date_column, time_column = derived
+            timestamps = date_time_to_ns(fields[positions[date_column]], fields[positions[time_column]])
+            chunk[name] = np.array(timestamps, dtype=np.int64)
+        yield columns, chunk
+
+def get_timestamp_column(data_type):
+    """Returns the name of the timestamp column in data_type's schema (or derived for it), or None if it has none."""
+    if data_type in DERIVED_TIMESTAMPS:
+        return DERIVED_TIMESTAMPS[data_type][0]
+    for name, kind in SCHEMAS.get(data_type, []):
+        if kind in ('timestamp_s', 'timestamp_ms'):
+            return name
+    return None
+
+# --- NumPy Columns ---
+def npy_header(dtype, rows):
+    """Builds a .npy (version 1.0) header of exactly NPY_HEADER_SIZE bytes for a 1-D array."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (dtype.str, rows)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+class NpyColumnWriter:
+    """Appends chunks of a 1-D array to a .npy file; the row count in the header is written on close()."""
+
+    def __init__(self, path, dtype):
+        self.dtype = dtype
+        self.rows = 0
+        self.file = open(path, 'wb')
+        self.file.write(npy_header(dtype, 0))
+
+    def append(self, array):
+        self.file.write(array.astype(self.dtype, copy=False).tobytes())
+        self.rows += len(array)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, self.rows))
+        self.file.close()
+
+def write_npy_columns(csv_path, output_dir, data_type):
+    """Writes every column of csv_path to output_dir/<column>.npy and describes them in meta.json.
+
+    Category columns are stored as int32 codes with their categories in meta.json. String columns
+    use an Arrow-like layout: <column>.offsets.npy (int64, rows + 1) into the UTF-8 bytes of <column>.data.
+    """
+    np = import_optional('numpy')
+    os.makedirs(output_dir, exist_ok=True)
+    writers = {}
+    data_files = {}
+    columns = []
+    categories = {}
+    rows = 0
+    try:
+        for columns, chunk in iter_typed_chunks(csv_path, data_type):
+            if not writers:
+                for name, kind in columns:
+                    if kind == 'string':
+                        writers[name] = NpyColumnWriter(os.path.join(output_dir, f"{name}.offsets.npy"), np.dtype('<i8'))
+                        writers[name].append(np.zeros(1, dtype=np.int64))
+                        data_files[name] = [open(os.path.join(output_dir, f"{name}.data"), 'wb'), 0]
+                    else:
+                        dtype = np.dtype('<i4') if kind == 'category' else chunk[name].dtype.newbyteorder('<')
+                        writers[name] = NpyColumnWriter(os.path.join(output_dir, f"{name}.npy"), dtype)
+            for name, kind in columns:
+                if kind == 'string':
+                    encoded = [value.encode('utf-8') for value in chunk[name]]
+                    data_file = data_files[name]
+                    offsets = np.cumsum([len(value) for value in encoded], dtype=np.int64) + data_file[1]
+                    data_file[0].write(b''.join(encoded))
+                    data_file[1] = int(offsets[-1]) if len(offsets) else data_file[1]
+                    writers[name].append(offsets)
+                else:
+                    writers[name].append(chunk[name])
+                    if kind == 'category':
+                        categories[name] = chunk[name + '.categories']
+            rows += len(chunk[columns[0][0]])
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for data_file, _ in data_files.values():
+            data_file.close()
+    meta = {
+        'data_type': data_type,
+        'rows': rows,
+        'columns': [dict({'name': name, 'kind': kind}, **({'categories': categories.get(name, [])} if kind == 'category' else {}))
+                    for name, kind in columns],
+    }
+    with open(os.path.join(output_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return rows
+
+# --- Parquet ---
+def write_parquet(csv_path, output_path, data_type):
+    """Writes csv_path to a Parquet file, one row group per chunk, with category columns dictionary-encoded."""
+    pa = import_optional('pyarrow')
+    pq = import_optional('pyarrow.parquet')
+    writer = None
+    rows = 0
+    try:
+        for columns, chunk in iter_typed_chunks(csv_path, data_type):
+            arrays = []
+            for name, kind in columns:
+                if kind == 'category':
+                    arrays.append(pa.DictionaryArray.from_arrays(chunk[name], pa.array(chunk[name + '.categories'], type=pa.string())))
+                elif kind == 'string':
+                    arrays.append(pa.array(chunk[name], type=pa.string()))
+                else:
+                    arrays.append(pa.array(chunk[name]))
+            table = pa.Table.from_arrays(arrays, names=[name for name, _ in columns])
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema, compression='zstd')
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+# --- Entry Point ---
+def convert_csv(csv_path, output_path, data_type, output_format):
+    """Converts a downloaded CSV to output_format at output_path and removes the CSV. Returns True on success.
+
+    The result is written under a temporary name and renamed into place, so output_path only ever
+    holds a complete conversion. On failure the CSV is kept.
+    """
+    tmp_path = f"{output_path}.tmp"
+    try:
+        logging.info(f'Converting: {csv_path} to {output_path}')
+        with metrics.timed('convert'):
+            if output_format == 'parquet':
+                write_parquet(csv_path, tmp_path, data_type)
+            elif output_format == 'npy':
+                write_npy_columns(csv_path, tmp_path, data_type)
+            else:
+                raise ValueError(f"Unknown output format '{output_format}'. Please use one of {OUTPUT_FORMATS}.")
+        metrics.add('bytes_in_total', os.path.getsize(csv_path), stage='convert')
+        os.replace(tmp_path, output_path)
+    except Exception as e:
+        logging.error(f"Error converting {csv_path} to {output_format}: {e}")
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    try:
+        os.remove(csv_path)
+    except OSError as e:
+        logging.warning(f"Could not remove converted CSV file {csv_path}: {e}")
+    return True
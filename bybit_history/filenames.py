@@ -0,0 +1,68 @@
+"""
+Parser for the file names used on the Bybit public data server (see example_of_api.md).
+"""
+
+import re
+import calendar
+from collections import namedtuple
+from datetime import date
+
+# Parsed file name. start/end are datetime.date objects and inclusive: a daily file has
+# start == end, a monthly spot file covers the whole month and a kline file covers its range.
+# interval is the kline interval in minutes as a string (None for other layouts) and suffix the
+# trailing data name (e.g. 'premium_index', 'index_price'; None if absent).
+FileInfo = namedtuple('FileInfo', ['symbol', 'start', 'end', 'interval', 'suffix'])
+
+# One pattern for all layouts:
+#   trading                BTCUSDT2020-03-25.csv.gz
+#   spot                   BTCUSDT-2022-11.csv.gz
+#   kline_for_metatrader4  BTCUSDT_15_2020-04-01_2020-04-30.csv.gz
+#   premium_index          BTCUSD2021-11-15_premium_index.csv.gz
+#   spot_index             BTCUSD2019-10-01_index_price.csv.gz
+# Any extension is accepted so extracted/converted local files parse the same way.
+FILENAME_PATTERN = re.compile(r"""
+    ^(?P<symbol>[A-Z0-9]+?)
+    (?:
+        _(?P<interval>\d+)_(?P<range_start>\d{4}-\d{2}-\d{2})_(?P<range_end>\d{4}-\d{2}-\d{2})
+      | -?(?P<year>\d{4})-(?P<month>\d{2})(?:-(?P<day>\d{2}))?
+    )
+    (?:_(?P<suffix>[a-z_]+))?
+    (?P<ext>(?:\.\w+)*)$
+""", re.VERBOSE)
+
+YEAR_PATTERN = re.compile(r'\d{4}')
+SYMBOL_PATTERN = re.compile(r'[A-Z0-9]+')
+
+def parse_filename(name):
+    """Parses a data file name into a FileInfo, or returns None if it does not match any known layout."""
+    match = FILENAME_PATTERN.match(name)
+    if not match:
+        return None
+    try:
+        if match.group('interval'):
+            start = date.fromisoformat(match.group('range_start'))
+            end = date.fromisoformat(match.group('range_end'))
+        else:
+            year, month = int(match.group('year')), int(match.group('month'))
+            if match.group('day'):
+                start = end = date(year, month, int(match.group('day')))
+            else:
+                start = date(year, month, 1)
+                end = date(year, month, calendar.monthrange(year, month)[1])
+    except ValueError:
+        return None # Matched the shape but not a real date (e.g. month 13)
+    return FileInfo(match.group('symbol'), start, end, match.group('interval'), match.group('suffix'))
+
+def overlaps(start, end, start_date, end_date=None):
+    """True if the inclusive period [start, end] overlaps the requested window (end_date None = open-ended)."""
+    return end >= start_date and (end_date is None or start <= end_date)
+
+def year_in_range(name, start_date, end_date=None):
+    """For a year directory name like '2020', tells whether that year overlaps the window.
+
+    Names that are not a year always return True, so the caller recurses into them as before.
+    """
+    if not YEAR_PATTERN.fullmatch(name):
+        return True
+    year = int(name)
+    return overlaps(date(year, 1, 1), date(year, 12, 31), start_date, end_date)
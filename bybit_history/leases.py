@@ -0,0 +1,160 @@
+"""
+Lock-file leases in a shared output directory, so several downloader processes can drain the same
+work without downloading a file twice.
+
+A lease is <output_dir>/.leases/<sha1 of key>.lease, created with O_CREAT | O_EXCL (atomic on local
+file systems and NFSv3+). Its holder refreshes the file's modification time in the background; a
+lease not refreshed for ttl seconds belongs to a crashed worker and is reclaimed by the next worker
+that wants it.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+
+LEASES_DIRNAME = '.leases'
+DEFAULT_LEASE_TTL = 600.0
+
+def get_worker_id():
+    """Identifies this process in lease files."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class LeaseManager:
+    """Acquires, refreshes and releases leases under <output_dir>/.leases/. Thread-safe."""
+
+    def __init__(self, output_dir, ttl=DEFAULT_LEASE_TTL, worker_id=None):
+        self.directory = os.path.join(output_dir, LEASES_DIRNAME)
+        self.ttl = ttl
+        self.worker_id = worker_id or get_worker_id()
+        self.held = {} # key -> lease path
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lease')
+
+    def create(self, path, key):
+        """Creates the lease file; False if it already exists."""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'key': key, 'owner': self.worker_id, 'acquired': time.time()}, f)
+        return True
+
+    def reclaim_if_stale(self, path):
+        """Removes a lease whose holder stopped refreshing it. Returns True if it was removed.
+
+        The stale file is first renamed to a name unique to this worker, so when several workers
+        find the same stale lease only one of them reclaims it. The age is checked again on the
+        renamed file: another worker may have reclaimed the stale lease and taken a fresh one
+        between the first check and the rename, and that fresh lease is put back.
+        """
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return True # Released in the meantime
+        if age <= self.ttl:
+            return False
+        claimed = f"{path}.{self.worker_id.replace(':', '-')}.stale"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return True # Another worker reclaimed it first
+        try:
+            age = time.time() - os.path.getmtime(claimed)
+        except FileNotFoundError:
+            return True
+        if age <= self.ttl:
+            self.restore(claimed, path)
+            return False
+        try:
+            with open(claimed, 'r', encoding='utf-8') as f:
+                previous = json.load(f).get('owner')
+        except (OSError, ValueError):
+            previous = 'unknown'
+        logging.warning(f"Reclaiming lease {os.path.basename(path)} from {previous} (not refreshed for {age:.0f}s)")
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+        return True
+
+    def restore(self, claimed, path):
+        """Puts back a live lease renamed by mistake, unless a new lease was created at path in the meantime."""
+        try:
+            os.link(claimed, path) # Unlike rename, never replaces an existing lease
+        except FileExistsError:
+            logging.warning(f"Lease {os.path.basename(path)} was taken again while being restored")
+        except OSError:
+            try:
+                os.rename(claimed, path) # File systems without hard links
+            except OSError as e:
+                logging.warning(f"Could not restore lease {os.path.basename(path)}: {e}")
+            return
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+
+    def acquire(self, key):
+        """Takes the lease for key. Returns False if another live worker holds it."""
+        path = self.get_path(key)
+        with self.lock:
+            if key in self.held:
+                return True
+        for _ in range(2):
+            if self.create(path, key):
+                with self.lock:
+                    self.held[key] = path
+                return True
+            if not self.reclaim_if_stale(path):
+                return False
+        return False
+
+    def release(self, key):
+        """Gives up the lease for key (if this worker holds it)."""
+        with self.lock:
+            path = self.held.pop(key, None)
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def refresh(self):
+        """Touches every held lease, marking this worker as alive."""
+        with self.lock:
+            paths = list(self.held.values())
+        for path in paths:
+            try:
+                os.utime(path, None)
+            except OSError as e:
+                logging.warning(f"Could not refresh lease {path}: {e}")
+
+    def start(self):
+        """Starts refreshing held leases in the background, three times per ttl."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.ttl / 3):
+            self.refresh()
+
+    def stop(self):
+        """Stops the refresh thread and releases every lease still held."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            keys = list(self.held)
+        for key in keys:
+            self.release(key)
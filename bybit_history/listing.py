@@ -0,0 +1,177 @@
+"""
+Directory listings of the Bybit public data server, with a persistent cache of conditional-request validators.
+"""
+
+import os
+import re
+import json
+import html
+import hashlib
+import logging
+import threading
+
+from . import metrics
+from .ratelimit import check_response
+
+# Name of the cache file kept in the output directory
+LISTING_CACHE_FILENAME = '.listing_cache.json'
+
+# Size column of nginx autoindex pages: exact bytes, or human readable (autoindex_exact_size off)
+SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)([KMGT]?)$')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(text):
+    """Returns the size shown after a link in an autoindex listing, in bytes, or None if there is none."""
+    fields = text.split() if text else []
+    match = SIZE_PATTERN.match(fields[-1]) if fields else None
+    if not match:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+# One link of an index page: <a href="...">text</a>, then the text up to the next tag (nginx
+# autoindex prints the date and size there). Only plain double-quoted anchors are matched.
+LINK_PATTERN = re.compile(r'<a href="([^"<>]*)">([^<]*)</a>([^<]*)', re.IGNORECASE)
+ANCHOR_PATTERN = re.compile(r'<a[\s>]', re.IGNORECASE)
+
+def parse_listing(page):
+    """Parses a directory listing page into a list of (href, text, size) tuples, one per link.
+
+    size is the file size printed after the link (nginx autoindex), or None when the page does not show one.
+    Plain index pages (nginx autoindex, Python http.server and similar generated listings) are parsed
+    in a single regular expression pass; pages with other markup fall back to BeautifulSoup.
+    """
+    links = parse_index_page(page)
+    if links is None:
+        links = parse_html_page(page)
+    return links
+
+def parse_index_page(page):
+    """Fast path of parse_listing. Returns None if some anchor of the page is not a plain <a href="...">."""
+    links = []
+    for href, text, following in LINK_PATTERN.findall(page):
+        if '&' in href:
+            href = html.unescape(href)
+        if '&' in text:
+            text = html.unescape(text)
+        if href:
+            links.append((href, text, parse_size(following) if not href.endswith('/') else None))
+    if len(links) != len(ANCHOR_PATTERN.findall(page)):
+        return None
+    return links
+
+def parse_html_page(page):
+    """Slow path of parse_listing, for markup the fast parser does not recognise."""
+    from bs4 import BeautifulSoup # Imported on demand: loading bs4 takes longer than parsing most listings
+
+    soup = BeautifulSoup(page, 'html.parser')
+    links = []
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        if not href:
+            continue
+        following = link.next_sibling
+        size = parse_size(following) if isinstance(following, str) and not href.endswith('/') else None
+        links.append((href, link.text, size))
+    return links
+
+def to_link(link):
+    """Converts a cached link (a JSON list, without size in caches written by older versions) to a tuple."""
+    link = tuple(link)
+    return link if len(link) == 3 else link + (None,)
+
+class ListingCache:
+    """Cache of parsed directory listings keyed by URL.
+
+    For every URL the cache stores the ETag/Last-Modified validators, a digest of the page and the
+    parsed links, so a listing can be revalidated with If-None-Match/If-Modified-Since instead of
+    being downloaded and parsed again. It also remembers which directories were completely walked,
+    and with which filters, which is what lets --sync skip the files of unchanged directories.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.fetched = {} # url -> (links, changed) for listings already fetched in this run
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read listing cache {path}, starting with an empty cache: {e}")
+
+    def save(self):
+        """Writes the cache to disk (atomically, through a temporary file)."""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp" # Unique per process: several may share an output directory
+        with self.lock:
+            data = json.dumps(self.entries, separators=(',', ':'))
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save listing cache {self.path}: {e}")
+
+    def fetch(self, session, url):
+        """Returns (links, changed) for a directory URL.
+
+        changed is False when the server answered 304 Not Modified or returned a page identical to
+        the cached one. Each URL is requested at most once per run. Request errors (including 404)
+        are raised to the caller as requests exceptions.
+        """
+        with self.lock:
+            if url in self.fetched:
+                return self.fetched[url]
+            cached = self.entries.get(url)
+
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        with metrics.timed('listing_fetch'):
+            response = session.get(url, headers=headers)
+        metrics.add('bytes_in_total', len(response.content), stage='listing_fetch')
+        if response.status_code == 304 and cached:
+            result = ([to_link(link) for link in cached['links']], False)
+        else:
+            check_response(response)
+            digest = hashlib.sha1(response.content).hexdigest()
+            if cached and cached.get('digest') == digest:
+                links = [to_link(link) for link in cached['links']]
+                changed = False
+            else:
+                with metrics.timed('listing_parse'):
+                    links = parse_listing(response.text)
+                changed = True
+            entry = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'digest': digest,
+                'links': links,
+                # A changed listing has to be walked again before it counts as complete
+                'complete': None if changed else (cached or {}).get('complete'),
+            }
+            with self.lock:
+                self.entries[url] = entry
+            result = (links, changed)
+
+        with self.lock:
+            self.fetched[url] = result
+        return result
+
+    def is_complete(self, url, sync_key):
+        """True if url was completely walked by an earlier run using the same filters (sync_key)."""
+        with self.lock:
+            entry = self.entries.get(url)
+            return bool(entry) and entry.get('complete') == sync_key
+
+    def set_complete(self, url, sync_key):
+        """Records that url was completely walked with sync_key (None clears the mark)."""
+        with self.lock:
+            if url in self.entries:
+                self.entries[url]['complete'] = sync_key
@@ -0,0 +1,207 @@
+"""
+Run metrics: per-stage latency histograms and counters, exported as a Prometheus textfile or JSON.
+
+Stages are the steps a file goes through: listing_fetch, listing_parse, download, decompress,
+write and convert. Hot paths accumulate their timings locally and record them once per file or
+listing, so instrumentation costs a few perf_counter() calls per file.
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets; +Inf is implied
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRIC_PREFIX = 'bybit_history'
+
+COUNTER_HELP = {
+    'bytes_in_total': 'Bytes read by a stage (network bytes for downloads and listings, compressed bytes for decompress)',
+    'bytes_out_total': 'Bytes produced by a stage (decompressed bytes, bytes written to disk)',
+    'retries_total': 'Requests retried after an error',
+    'files_total': 'Files handled, by result',
+    'throttled_total': 'Responses asking to slow down (429/503)',
+    'circuit_open_total': 'Times the circuit breaker stopped requests to a failing host',
+}
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Approximate quantile: the upper bound of the bucket holding it (inf for the last bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """Thread-safe registry of stage histograms and labelled counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {} # (name, ((label, value), ...)) -> value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """Returns the current values as a JSON-serializable dict."""
+        with self.lock:
+            stages = {
+                stage: {
+                    'count': histogram.count,
+                    'sum_seconds': round(histogram.sum, 6),
+                    'p50_seconds': histogram.quantile(0.5),
+                    'p95_seconds': histogram.quantile(0.95),
+                    'buckets': dict(zip([str(bound) for bound in HISTOGRAM_BUCKETS] + ['+Inf'], histogram.counts)),
+                }
+                for stage, histogram in sorted(self.histograms.items())
+            }
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+        return {'started': self.started, 'elapsed_seconds': round(time.time() - self.started, 3), 'stages': stages, 'counters': counters}
+
+    def to_prometheus(self):
+        """Renders the metrics in the Prometheus text exposition format."""
+        lines = [
+            f'# HELP {METRIC_PREFIX}_stage_seconds Time spent per file (or listing) in each stage',
+            f'# TYPE {METRIC_PREFIX}_stage_seconds histogram',
+        ]
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(HISTOGRAM_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {COUNTER_HELP.get(name, name)}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} counter')
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+                    lines.append(f'{METRIC_PREFIX}_{name}{{{label_text}}} {value}')
+        lines.append(f'# HELP {METRIC_PREFIX}_run_start_time_seconds Start time of the run (Unix time)')
+        lines.append(f'# TYPE {METRIC_PREFIX}_run_start_time_seconds gauge')
+        lines.append(f'{METRIC_PREFIX}_run_start_time_seconds {self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to path atomically: JSON if it ends with .json, otherwise a Prometheus textfile."""
+        if path.endswith('.json'):
+            data = json.dumps(self.snapshot(), indent=2)
+        else:
+            data = self.to_prometheus()
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write metrics to {path}: {e}")
+
+    def format_summary(self):
+        """One line per stage for the end-of-run log."""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for stage, histogram in histograms:
+            bytes_in = self.get('bytes_in_total', stage=stage)
+            bytes_out = self.get('bytes_out_total', stage=stage)
+            line = f"{stage}: {histogram.count} x, {histogram.sum:.2f}s total, p95 <= {histogram.quantile(0.95)}s"
+            if bytes_in:
+                line += f", in {bytes_in / 1e6:.1f} MB ({bytes_in / 1e6 / histogram.sum if histogram.sum else 0:.1f} MB/s)"
+            if bytes_out:
+                line += f", out {bytes_out / 1e6:.1f} MB"
+            retries = self.get('retries_total', stage=stage)
+            if retries:
+                line += f", {retries} retries"
+            lines.append(line)
+        return lines
+
+# Registry shared by the whole run
+_metrics = Metrics()
+
+def get_metrics():
+    return _metrics
+
+def reset():
+    """Starts a fresh registry (e.g. for a new run in the same process)."""
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+def observe(stage, seconds):
+    _metrics.observe(stage, seconds)
+
+def add(name, value=1, **labels):
+    _metrics.add(name, value, **labels)
+
+@contextmanager
+def timed(stage):
+    """Records the time spent in the with block under stage (also when it raises)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.observe(stage, time.perf_counter() - started)
+
+class PeriodicExporter:
+    """Background thread that writes the metrics to path every interval seconds until stop()."""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            _metrics.write(self.path)
+
+    def stop(self):
+        """Stops the thread and writes the final values."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        _metrics.write(self.path)
@@ -0,0 +1,20 @@
+"""
+Helpers for the optional dependencies (numpy, pyarrow) used by the columnar formats and the reader API.
+"""
+
+import importlib
+
+# Poetry extra that installs each optional module
+EXTRAS = {
+    'numpy': 'numpy',
+    'pyarrow': 'parquet',
+    'pyarrow.parquet': 'parquet',
+}
+
+def import_optional(module_name):
+    """Imports an optional dependency, raising an ImportError that names the extra to install if it is missing."""
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as e:
+        extra = EXTRAS.get(module_name, module_name)
+        raise ImportError(f"'{module_name}' is required for this feature. Install it with: pip install 'bybit-history[{extra}]'") from e
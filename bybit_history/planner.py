@@ -0,0 +1,96 @@
+"""
+Download plans: the list of files a run will fetch, built by crawling the listings before anything
+is downloaded. Plans can be printed (--dry-run), saved to JSON (--plan-file) and executed later
+(--from-plan), in date or size order.
+"""
+
+import os
+import json
+import time
+from collections import namedtuple
+
+# One file to download. archive_path/extracted_path are absolute (resolved against the output
+# directory); size is the archive size from the listing, or None if the listing does not show it.
+DownloadJob = namedtuple('DownloadJob', ['data_type', 'name', 'date', 'url', 'archive_path', 'extracted_path', 'symbol', 'size'])
+
+PLAN_ORDERS = ['date', 'size', 'size-desc']
+
+PLAN_VERSION = 1
+
+def order_jobs(jobs, order='date'):
+    """Sorts jobs: by date (oldest first), size (smallest first) or size-desc (largest first).
+
+    Jobs of unknown size go last in both size orders. Ties are broken by data type and name, so the
+    order does not depend on how the crawl happened to finish.
+    """
+    if order == 'date':
+        return sorted(jobs, key=lambda job: (job.date, job.data_type, job.name))
+    if order == 'size':
+        return sorted(jobs, key=lambda job: (job.size is None, job.size or 0, job.date, job.name))
+    if order == 'size-desc':
+        return sorted(jobs, key=lambda job: (job.size is None, -(job.size or 0), job.date, job.name))
+    raise ValueError(f"Unknown plan order '{order}'. Please use one of {PLAN_ORDERS}.")
+
+def estimate_bytes(jobs):
+    """Returns (known_bytes, unknown_count, estimated_total); unknown sizes are estimated with the mean known size."""
+    known = [job.size for job in jobs if job.size is not None]
+    known_bytes = sum(known)
+    unknown_count = len(jobs) - len(known)
+    mean = known_bytes / len(known) if known else 0
+    return known_bytes, unknown_count, int(known_bytes + unknown_count * mean)
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def describe_jobs(jobs):
+    """'<n> files, <size>', with an estimate for files whose size the listing did not show."""
+    known_bytes, unknown_count, estimate = estimate_bytes(jobs)
+    text = f"{len(jobs)} files, {format_size(known_bytes)}"
+    if unknown_count == len(jobs) and jobs:
+        text = f"{len(jobs)} files of unknown size"
+    elif unknown_count:
+        text += f" (+{unknown_count} files of unknown size, ~{format_size(estimate)} estimated)"
+    return text
+
+def format_plan_summary(jobs):
+    """Returns summary lines: files and bytes per data type, and the total."""
+    lines = []
+    for data_type in sorted({job.data_type for job in jobs}):
+        lines.append(f"{data_type}: {describe_jobs([job for job in jobs if job.data_type == data_type])}")
+    lines.append(f"Total: {describe_jobs(jobs)}")
+    return lines
+
+def save_plan(path, jobs, output_dir, meta=None):
+    """Writes jobs to path as JSON. Paths are stored relative to output_dir. Written atomically."""
+    data = {
+        'version': PLAN_VERSION,
+        'created': time.time(),
+        'meta': meta or {},
+        'jobs': [
+            dict(job._asdict(),
+                 archive_path=os.path.relpath(job.archive_path, output_dir),
+                 extracted_path=os.path.relpath(job.extracted_path, output_dir))
+            for job in jobs
+        ],
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+def load_plan(path, output_dir):
+    """Reads a plan written by save_plan, resolving its paths against output_dir. Returns (jobs, meta)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version {data.get('version')} in {path}")
+    jobs = []
+    for entry in data['jobs']:
+        entry['archive_path'] = os.path.join(output_dir, entry['archive_path'])
+        entry['extracted_path'] = os.path.join(output_dir, entry['extracted_path'])
+        jobs.append(DownloadJob(**entry))
+    return jobs, data.get('meta', {})
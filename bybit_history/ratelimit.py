@@ -0,0 +1,226 @@
+"""
+Adaptive request rate control shared by listing and file requests.
+
+Per host, a RateController combines:
+  - a token bucket limiting requests per second, whose rate is raised additively after successes
+    and halved when the server throttles (429/503);
+  - an AIMD concurrency window limiting requests in flight, grown by 1/window per success and
+    halved on throttling or connection failures;
+  - Retry-After handling: a 429/503 pauses every request to that host for the announced time;
+  - retries with jittered exponential backoff;
+  - a circuit breaker: after several consecutive failures, requests wait out a cooldown, then a
+    single probe request decides whether the host is back (the others keep waiting for it). Once
+    several probes in a row have failed, the host is treated as down and requests fail fast
+    until a probe succeeds.
+"""
+
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from . import metrics
+
+# Defaults for the command line options
+DEFAULT_MAX_RATE = 20.0 # Requests per second per host
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Lowest rate the token bucket is throttled down to (requests per second)
+MIN_RATE = 0.2
+# Rate added back after each successful request
+RATE_INCREASE = 0.5
+
+# Exponential backoff: BACKOFF_BASE * 2 ** (attempt - 1), capped, with full jitter
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# Longest Retry-After that is honoured as is
+RETRY_AFTER_CAP = 300.0
+
+# Consecutive failures that open a host's circuit, and how long it stays open
+BREAKER_THRESHOLD = 8
+BREAKER_COOLDOWN = 30.0
+# Failed probes in a row after which requests stop waiting for the host and fail fast
+BREAKER_MAX_PROBES = 5
+
+# Statuses meaning the server wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+class ServerBusyError(requests.exceptions.HTTPError):
+    """The server answered 429 or 503; retry_after holds its Retry-After delay in seconds (or None)."""
+
+    def __init__(self, message, response=None, retry_after=None):
+        super().__init__(message, response=response)
+        self.retry_after = retry_after
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without sending a request to a host whose circuit breaker probes keep failing."""
+
+def parse_retry_after(value):
+    """Converts a Retry-After header (seconds or HTTP date) to seconds, or None if missing/invalid."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def check_response(response):
+    """Like response.raise_for_status(), but raises ServerBusyError for 429/503."""
+    if response.status_code in THROTTLE_STATUSES:
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        raise ServerBusyError(f"{response.status_code} from {response.url} (Retry-After: {retry_after})", response=response, retry_after=retry_after)
+    response.raise_for_status()
+
+def classify_error(error, retry_on=()):
+    """Returns the outcome of a failed attempt: 'throttled', 'failure' (retryable), 'neutral' or None (not retryable)."""
+    if isinstance(error, ServerBusyError):
+        return 'throttled'
+    if isinstance(error, CircuitOpenError):
+        return None
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        # Server errors are worth retrying; a 4xx (e.g. 404) is a valid answer from a healthy host
+        return 'failure' if status is None or status >= 500 else 'neutral'
+    if isinstance(error, requests.exceptions.RequestException) or isinstance(error, retry_on):
+        return 'failure'
+    return None
+
+class HostState:
+    def __init__(self, max_rate, max_window):
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.window = float(max_window)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.failures = 0 # Consecutive failures, for the circuit breaker
+        self.open_until = 0.0
+        self.probing = False # A probe request is in flight
+        self.failed_probes = 0 # Consecutive probes that failed
+
+class RateController:
+    """Admission control and retries for requests, per host. Thread-safe; share one per run."""
+
+    def __init__(self, max_rate=DEFAULT_MAX_RATE, max_window=1, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.max_rate = max_rate # 0 disables the token bucket
+        self.max_window = max(1, max_window)
+        self.max_attempts = max(1, max_attempts)
+        self.hosts = {}
+        self.condition = threading.Condition()
+        self.random = random.Random()
+
+    def get_host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.max_rate, self.max_window)
+        return state
+
+    def acquire(self, host):
+        """Blocks until a request to host may be sent; returns True if it is the circuit breaker's probe.
+
+        While the circuit is open this waits for the cooldown and then for the probe's outcome.
+        Raises CircuitOpenError instead once BREAKER_MAX_PROBES probes in a row have failed.
+        """
+        with self.condition:
+            state = self.get_host(host)
+            probe = False
+            while True:
+                now = time.monotonic()
+                if state.failures >= BREAKER_THRESHOLD and not probe:
+                    if state.failed_probes >= BREAKER_MAX_PROBES and now < state.open_until:
+                        raise CircuitOpenError(f"{host} is down: {state.failed_probes} probes failed after {state.failures} consecutive failures")
+                    if state.probing or now < state.open_until:
+                        self.condition.wait(None if state.probing else state.open_until - now)
+                        continue
+                    # Half-open: this request is the probe; everyone else waits until it completes
+                    state.probing = probe = True
+                wait = None
+                if state.paused_until > now:
+                    wait = state.paused_until - now
+                elif state.in_flight < int(state.window):
+                    if not self.max_rate:
+                        break
+                    state.tokens = min(max(1.0, state.rate), state.tokens + (now - state.refilled) * state.rate)
+                    state.refilled = now
+                    if state.tokens >= 1:
+                        state.tokens -= 1
+                        break
+                    wait = (1 - state.tokens) / state.rate
+                self.condition.wait(wait)
+            state.in_flight += 1
+            return probe
+
+    def release(self, host, outcome, retry_after=None, probe=False):
+        """Records the outcome of a request ('success', 'neutral', 'throttled' or 'failure') and frees its slot.
+
+        probe is what acquire() returned for the request.
+        """
+        with self.condition:
+            state = self.get_host(host)
+            state.in_flight -= 1
+            if probe:
+                state.probing = False
+            if outcome in ('success', 'neutral'):
+                state.failures = 0
+                state.failed_probes = 0
+                state.window = min(float(self.max_window), state.window + 1 / state.window)
+                if self.max_rate:
+                    state.rate = min(self.max_rate, state.rate + RATE_INCREASE)
+            elif outcome in ('throttled', 'failure'):
+                state.failures += 1
+                state.window = max(1.0, state.window / 2)
+                if probe:
+                    state.failed_probes += 1
+                if state.failures >= BREAKER_THRESHOLD:
+                    state.open_until = time.monotonic() + BREAKER_COOLDOWN
+                    logging.warning(f"Too many consecutive failures from {host}; pausing requests for {BREAKER_COOLDOWN:.0f}s")
+                    metrics.add('circuit_open_total')
+                if outcome == 'throttled':
+                    metrics.add('throttled_total')
+                    if self.max_rate:
+                        state.rate = max(MIN_RATE, state.rate / 2)
+                    if retry_after is not None:
+                        state.paused_until = max(state.paused_until, time.monotonic() + min(retry_after, RETRY_AFTER_CAP))
+            self.condition.notify_all()
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retry number attempt (1-based)."""
+        with self.condition:
+            return self.random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+    def call(self, url, operation, stage, retry_on=()):
+        """Runs operation() as a request to url's host, retrying failures. Returns its result.
+
+        operation must raise for bad responses (use check_response). Throttling, server errors,
+        connection errors and exceptions in retry_on are retried up to max_attempts times with
+        jittered exponential backoff (at least the server's Retry-After); anything else, a 4xx, or
+        the last failure is raised to the caller. Waiting for an open circuit (see acquire) does not
+        use up an attempt.
+        """
+        host = urlsplit(url).netloc
+        attempt = 1
+        while True:
+            probe = self.acquire(host)
+            try:
+                result = operation()
+            except Exception as e:
+                outcome = classify_error(e, retry_on)
+                retry_after = getattr(e, 'retry_after', None)
+                self.release(host, outcome or 'neutral', retry_after, probe)
+                if outcome not in ('throttled', 'failure') or attempt >= self.max_attempts:
+                    raise
+                delay = max(self.backoff(attempt), min(retry_after or 0, RETRY_AFTER_CAP))
+                logging.warning(f"{url}: {e} (attempt {attempt}/{self.max_attempts}); retrying in {delay:.1f}s")
+                metrics.add('retries_total', stage=stage)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.release(host, 'success', probe=probe)
+            return result
@@ -0,0 +1,293 @@
+"""
+Reader API: lazy, batched iteration over downloaded files for a data type, symbols and a date range.
+"""
+
+import io
+import os
+import csv
+import json
+import calendar
+from datetime import date, datetime, timedelta, timezone
+
+from .blockgz import BLOCKED_EXTENSION, is_blocked_complete, iter_blocks, read_index
+from .columnar import FORMAT_EXTENSIONS, get_timestamp_column, iter_typed_chunks, iter_typed_row_chunks
+from .filenames import YEAR_PATTERN, overlaps, parse_filename, year_in_range
+from .optional import import_optional
+from .timeindex import iter_range_rows, read_time_index
+
+# Rows per batch yielded by read()
+DEFAULT_BATCH_ROWS = 65536
+
+# When the same file exists in several formats, the first format in this list is read
+FORMAT_PREFERENCE = ['npy', 'parquet', 'bgzip', 'csv']
+
+def to_date(value):
+    """Accepts 'YYYY-MM-DD', a date or a datetime and returns a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+def to_ns(value):
+    """Converts a datetime (naive = UTC) or date to integer nanoseconds since the epoch."""
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return calendar.timegm(value.timetuple()) * 1000000000 + value.microsecond * 1000
+
+def get_time_bounds(start, end=None):
+    """Returns inclusive (start_ns, end_ns) bounds. A date as end means the whole of that day; None means no bound."""
+    start_value = date.fromisoformat(start) if isinstance(start, str) else start
+    start_ns = to_ns(start_value)
+    if end is None:
+        return start_ns, None
+    end_value = date.fromisoformat(end) if isinstance(end, str) else end
+    if isinstance(end_value, datetime):
+        return start_ns, to_ns(end_value)
+    return start_ns, to_ns(end_value + timedelta(days=1)) - 1
+
+def get_file_format(name):
+    """Returns (format, base name) for a downloaded file name, or (None, None) if it is not a data file."""
+    if name.endswith(BLOCKED_EXTENSION):
+        return 'bgzip', name[:-len(BLOCKED_EXTENSION)]
+    for output_format, extension in FORMAT_EXTENSIONS.items():
+        if name.endswith(extension):
+            return output_format, name[:-len(extension)]
+    if name.endswith('.csv'):
+        return 'csv', name[:-4]
+    return None, None
+
+def find_files(data_type, symbol, start, end=None, output_dir='./data'):
+    """Returns [(FileInfo, format, path)] for symbol's files whose period overlaps [start, end], oldest first.
+
+    Looks in output_dir/<data_type>/<symbol>/ and its year subdirectories, using the same file
+    names the downloader writes. Files still being written (.tmp/.part, or a .csv.bgz without its
+    index) are ignored.
+    """
+    start_date = to_date(start)
+    end_date = to_date(end) if end is not None else None
+    symbol_dir = os.path.join(output_dir, data_type, symbol)
+    if not os.path.isdir(symbol_dir):
+        return []
+    directories = [symbol_dir]
+    for name in sorted(os.listdir(symbol_dir)):
+        if YEAR_PATTERN.fullmatch(name) and year_in_range(name, start_date, end_date):
+            directories.append(os.path.join(symbol_dir, name))
+
+    found = {}
+    for directory in directories:
+        for name in os.listdir(directory):
+            output_format, base = get_file_format(name)
+            if output_format is None:
+                continue
+            path = os.path.join(directory, name)
+            if output_format == 'bgzip' and not is_blocked_complete(path):
+                continue
+            info = parse_filename(name)
+            if info is None or info.symbol != symbol or not overlaps(info.start, info.end, start_date, end_date):
+                continue
+            key = (directory, base)
+            rank = FORMAT_PREFERENCE.index(output_format)
+            if key not in found or rank < found[key][0]:
+                found[key] = (rank, info, output_format, path)
+    return sorted(((info, output_format, path) for _, info, output_format, path in found.values()),
+                  key=lambda item: (item[0].start, item[2]))
+
+# --- Per-Format Readers ---
+# Each yields dicts of column name -> numpy array, already restricted to [start_ns, end_ns].
+# Category columns are decoded to object arrays of str. Rows are assumed to be sorted by
+# timestamp within a file, as Bybit publishes them.
+
+def time_mask(np, timestamps, start_ns, end_ns):
+    """Boolean mask of timestamps inside the inclusive bounds (None = unbounded)."""
+    mask = np.ones(len(timestamps), dtype=bool)
+    if start_ns is not None:
+        mask &= timestamps >= start_ns
+    if end_ns is not None:
+        mask &= timestamps <= end_ns
+    return mask
+
+def iter_chunk_batches(np, chunks, names, timestamp_column, start_ns, end_ns):
+    """Turns typed chunks from iter_typed_row_chunks into filtered batches of numpy arrays."""
+    for columns, chunk in chunks:
+        kinds = dict(columns)
+        selected = names or [name for name, _ in columns]
+        mask = None
+        if timestamp_column in chunk and (start_ns is not None or end_ns is not None):
+            mask = time_mask(np, chunk[timestamp_column], start_ns, end_ns)
+            if not mask.any():
+                continue
+        batch = {}
+        for name in selected:
+            if name not in kinds:
+                raise KeyError(f"Column '{name}' not found. Available columns: {[column for column, _ in columns]}")
+            if kinds[name] == 'category':
+                values = np.array(chunk[name + '.categories'], dtype=object)[chunk[name]]
+            elif kinds[name] == 'string':
+                values = np.array(chunk[name], dtype=object)
+            else:
+                values = chunk[name]
+            batch[name] = values[mask] if mask is not None else values
+        yield batch
+
+def iter_csv(np, path, data_type, names, start_ns, end_ns, batch_size):
+    """Reads a plain CSV file in batches. With a time range and a time index, only the indexed part of the file in range is read."""
+    index = read_time_index(path) if start_ns is not None or end_ns is not None else None
+    if index is not None:
+        chunks = iter_typed_row_chunks(iter_range_rows(path, start_ns, end_ns, index), data_type, batch_size)
+    else:
+        chunks = iter_typed_chunks(path, data_type, batch_size)
+    yield from iter_chunk_batches(np, chunks, names, get_timestamp_column(data_type), start_ns, end_ns)
+
+def iter_bgzip(np, path, data_type, names, start_ns, end_ns, batch_size):
+    """Reads a blocked .csv.bgz file, decompressing only the blocks that can hold rows in range."""
+    index = read_index(path)
+
+    def rows():
+        if index['header']:
+            yield next(csv.reader([index['header']]))
+        for position, data in iter_blocks(path, start_ns, end_ns, index):
+            text = data.decode('utf-8')
+            if position == 0 and index['header']:
+                text = text.split('\n', 1)[1] if '\n' in text else '' # Header already yielded
+            yield from csv.reader(io.StringIO(text, newline=''))
+
+    chunks = iter_typed_row_chunks(rows(), data_type, batch_size)
+    yield from iter_chunk_batches(np, chunks, names, get_timestamp_column(data_type), start_ns, end_ns)
+
+def iter_parquet(np, path, data_type, names, start_ns, end_ns, batch_size):
+    """Reads a Parquet file in batches, skipping row groups whose timestamp statistics are out of range."""
+    pq = import_optional('pyarrow.parquet')
+    parquet_file = pq.ParquetFile(path)
+    schema_names = parquet_file.schema_arrow.names
+    selected = names or schema_names
+    timestamp_column = get_timestamp_column(data_type)
+    bounded = timestamp_column in schema_names and (start_ns is not None or end_ns is not None)
+    read_columns = list(selected) + ([timestamp_column] if bounded and timestamp_column not in selected else [])
+
+    row_groups = list(range(parquet_file.num_row_groups))
+    if bounded:
+        position = schema_names.index(timestamp_column)
+        kept = []
+        for row_group in row_groups:
+            statistics = parquet_file.metadata.row_group(row_group).column(position).statistics
+            if statistics is not None and statistics.has_min_max:
+                if (start_ns is not None and statistics.max < start_ns) or (end_ns is not None and statistics.min > end_ns):
+                    continue
+            kept.append(row_group)
+        row_groups = kept
+    if not row_groups:
+        return
+
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=read_columns):
+        mask = None
+        if bounded:
+            mask = time_mask(np, record_batch.column(timestamp_column).to_numpy(), start_ns, end_ns)
+            if not mask.any():
+                continue
+        batch = {}
+        for name in selected:
+            values = record_batch.column(name).to_numpy(zero_copy_only=False)
+            batch[name] = values[mask] if mask is not None else values
+        yield batch
+
+def iter_npy(np, path, data_type, names, start_ns, end_ns, batch_size):
+    """Reads a .columns directory through memory maps; only the pages of the requested rows are touched."""
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    described = {column['name']: column for column in meta['columns']}
+    selected = names or [column['name'] for column in meta['columns']]
+    for name in selected:
+        if name not in described:
+            raise KeyError(f"Column '{name}' not found. Available columns: {list(described)}")
+
+    rows = meta['rows']
+    first, last = 0, rows
+    timestamp_column = get_timestamp_column(data_type)
+    if timestamp_column in described and rows:
+        # Sorted timestamps: binary search the memory-mapped column instead of scanning it
+        timestamps = np.load(os.path.join(path, f"{timestamp_column}.npy"), mmap_mode='r')
+        if start_ns is not None:
+            first = int(np.searchsorted(timestamps, start_ns, side='left'))
+        if end_ns is not None:
+            last = int(np.searchsorted(timestamps, end_ns, side='right'))
+
+    columns = {}
+    for name in selected:
+        column = described[name]
+        if column['kind'] == 'string':
+            offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode='r')
+            data_path = os.path.join(path, f"{name}.data")
+            data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) else np.zeros(0, dtype=np.uint8)
+            columns[name] = (column, offsets, data)
+        else:
+            categories = np.array(column['categories'], dtype=object) if column['kind'] == 'category' else None
+            columns[name] = (column, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'), categories)
+
+    for offset in range(first, last, batch_size):
+        stop = min(last, offset + batch_size)
+        batch = {}
+        for name, (column, values, extra) in columns.items():
+            if column['kind'] == 'string':
+                positions = values[offset:stop + 1]
+                raw = extra[positions[0]:positions[-1]].tobytes()
+                starts = positions - positions[0]
+                batch[name] = np.array([raw[starts[i]:starts[i + 1]].decode('utf-8') for i in range(stop - offset)], dtype=object)
+            elif column['kind'] == 'category':
+                batch[name] = extra[values[offset:stop]]
+            else:
+                batch[name] = values[offset:stop] # Read-only view into the memory map
+        yield batch
+
+FORMAT_READERS = {
+    'csv': iter_csv,
+    'bgzip': iter_bgzip,
+    'parquet': iter_parquet,
+    'npy': iter_npy,
+}
+
+def rebatch(np, batches, batch_size):
+    """Regroups batches of any size into batches of exactly batch_size rows (the last one may be shorter)."""
+    pending = []
+    pending_rows = 0
+    for batch in batches:
+        rows = len(next(iter(batch.values()))) if batch else 0
+        if not rows:
+            continue
+        pending.append(batch)
+        pending_rows += rows
+        while pending_rows >= batch_size:
+            merged = pending[0] if len(pending) == 1 else {name: np.concatenate([part[name] for part in pending]) for name in pending[0]}
+            yield {name: values[:batch_size] for name, values in merged.items()}
+            rest = {name: values[batch_size:] for name, values in merged.items()}
+            pending_rows -= batch_size
+            pending = [rest] if pending_rows else []
+    if pending_rows:
+        yield pending[0] if len(pending) == 1 else {name: np.concatenate([part[name] for part in pending]) for name in pending[0]}
+
+def read(data_type, symbols, start, end=None, columns=None, batch_size=DEFAULT_BATCH_ROWS, output_dir='./data'):
+    """Lazily yields batches of downloaded data as dicts of column name -> numpy array.
+
+    data_type is one of the downloader's data types and symbols a symbol or list of symbols.
+    start/end are 'YYYY-MM-DD' strings, dates or datetimes (naive = UTC); a date as end includes
+    that whole day, and end=None reads to the newest file. columns limits the columns returned.
+
+    Only files overlapping the range are opened, rows outside it are dropped, and every batch
+    has batch_size rows except the last one of each symbol. Batches never mix symbols. Timestamps
+    are int64 nanoseconds and category/string columns are object arrays of str. Kline files,
+    which only have date and time columns, get a 'timestamp' column derived from them (UTC) that
+    the range applies to. Batches read from the npy format may be read-only views into
+    memory-mapped files; copy them to modify.
+    """
+    np = import_optional('numpy')
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    start_ns, end_ns = get_time_bounds(start, end)
+    for symbol in symbols:
+        def symbol_batches(symbol=symbol):
+            for _, output_format, path in find_files(data_type, symbol, start, end, output_dir):
+                reader = FORMAT_READERS[output_format]
+                yield from reader(np, path, data_type, columns, start_ns, end_ns, batch_size)
+        yield from rebatch(np, symbol_batches(), batch_size)
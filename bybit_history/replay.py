@@ -0,0 +1,173 @@
+"""
+Multi-symbol replay: one stream of downloaded rows across symbols, in global timestamp order.
+
+Each symbol is read lazily with reader.read(), one batch per symbol in memory at a time, and the
+symbols are k-way merged with a heap keyed on the last timestamp of each symbol's current batch.
+The smallest of those is a horizon up to which every symbol's rows are known: each merge step
+takes the rows up to the horizon from all symbols, orders them with one vectorized sort, and
+loads the next batch of the symbols it exhausted.
+"""
+
+import os
+import sys
+import csv
+import heapq
+import logging
+import argparse
+
+from .columnar import get_timestamp_column
+from .optional import import_optional
+from .reader import DEFAULT_BATCH_ROWS, read, rebatch
+
+SYMBOL_COLUMN = 'symbol'
+
+class ReplaySource:
+    """One symbol's batches, with a read position inside the current batch."""
+
+    def __init__(self, np, symbol, batches, timestamp_column):
+        self.np = np
+        self.symbol = symbol
+        self.batches = batches
+        self.timestamp_column = timestamp_column
+        self.batch = None
+        self.position = 0
+        self.last_timestamp = None
+        self.warned = False
+
+    def advance(self):
+        """Loads the next non-empty batch. Returns False when the symbol has no more rows."""
+        np = self.np
+        for batch in self.batches:
+            timestamps = batch[self.timestamp_column]
+            if not len(timestamps):
+                continue
+            if len(timestamps) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+                order = np.argsort(timestamps, kind='stable')
+                batch = {name: values[order] for name, values in batch.items()}
+                timestamps = batch[self.timestamp_column]
+            if self.last_timestamp is not None and timestamps[0] < self.last_timestamp and not self.warned:
+                logging.warning(f"{self.symbol}: rows are not in time order across batches; the replay is only ordered within each batch for this symbol")
+                self.warned = True
+            self.last_timestamp = timestamps[-1]
+            self.batch = batch
+            self.position = 0
+            return True
+        self.batch = None
+        return False
+
+    def last(self):
+        """Timestamp of the last row of the current batch."""
+        return self.batch[self.timestamp_column][-1]
+
+    def take(self, horizon):
+        """Returns the rows of the current batch up to horizon (with a symbol column) and moves past them."""
+        timestamps = self.batch[self.timestamp_column]
+        stop = self.position + int(self.np.searchsorted(timestamps[self.position:], horizon, side='right'))
+        run = {name: values[self.position:stop] for name, values in self.batch.items()}
+        run[SYMBOL_COLUMN] = self.np.full(stop - self.position, self.symbol, dtype=object)
+        self.position = stop
+        return run
+
+def merge_sources(np, sources, timestamp_column):
+    """k-way merges sources, yielding batches of rows in global time order (one per merge step).
+
+    Rows with equal timestamps are ordered by the position of their symbol in sources, except
+    where they straddle a batch boundary.
+    """
+    heap = [(source.last(), index) for index, source in enumerate(sources) if source.advance()]
+    heapq.heapify(heap)
+    while heap:
+        horizon = heap[0][0]
+        runs = []
+        positions = []
+        for index, source in enumerate(sources):
+            if source.batch is None:
+                continue
+            run = source.take(horizon)
+            if len(run[SYMBOL_COLUMN]):
+                runs.append(run)
+                positions.append(np.full(len(run[SYMBOL_COLUMN]), index))
+        if len(runs) == 1:
+            yield runs[0]
+        else:
+            merged = {name: np.concatenate([run[name] for run in runs]) for name in runs[0]}
+            order = np.lexsort((np.concatenate(positions), merged[timestamp_column])) # Stable: rows of one symbol keep their order
+            yield {name: values[order] for name, values in merged.items()}
+        # Every batch ending at the horizon is now exhausted
+        while heap and heap[0][0] == horizon:
+            _, index = heapq.heappop(heap)
+            if sources[index].advance():
+                heapq.heappush(heap, (sources[index].last(), index))
+
+def replay(data_type, symbols, start, end=None, columns=None, batch_size=DEFAULT_BATCH_ROWS, output_dir='./data'):
+    """Lazily yields batches of several symbols' downloaded data, merged in timestamp order.
+
+    Arguments are those of reader.read(). Every batch is a dict of column name -> numpy array with
+    batch_size rows (except the last), ordered by the timestamp column across all symbols, plus a
+    'symbol' column (object array of str) naming each row's symbol. The timestamp column is always
+    included. Memory use is a few batches per symbol, whatever the time range.
+
+    Rows of each symbol are expected in time order, as Bybit publishes them; a batch that is not is
+    sorted before merging.
+    """
+    np = import_optional('numpy')
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    timestamp_column = get_timestamp_column(data_type)
+    if timestamp_column is None:
+        raise ValueError(f"Data type '{data_type}' has no timestamp column to replay by.")
+    if columns is not None:
+        columns = [timestamp_column] + [name for name in columns if name not in (timestamp_column, SYMBOL_COLUMN)]
+    sources = [
+        ReplaySource(np, symbol, read(data_type, symbol, start, end, columns, batch_size, output_dir), timestamp_column)
+        for symbol in symbols
+    ]
+    yield from rebatch(np, merge_sources(np, sources, timestamp_column), batch_size)
+
+def write_csv(batches, output, columns=None):
+    """Writes replayed batches to a text stream as CSV (header from the first batch). Returns the rows written."""
+    writer = csv.writer(output, lineterminator='\n')
+    names = None
+    rows = 0
+    for batch in batches:
+        if names is None:
+            names = columns or list(batch)
+            writer.writerow(names)
+        writer.writerows(zip(*[batch[name].tolist() for name in names]))
+        rows += len(batch[names[0]])
+    return rows
+
+def main(argv=None):
+    """Entry point of the 'replay' subcommand."""
+    parser = argparse.ArgumentParser(prog='start replay', description='Replay downloaded data of several symbols as one CSV stream in timestamp order')
+    parser.add_argument('--coins', required=True, help='Comma-separated list of coin pairs (e.g., BTCUSDT,ETHUSDT)')
+    parser.add_argument('--start-date', required=True, help='Start date in YYYY-MM-DD format')
+    parser.add_argument('--end-date', help='End date in YYYY-MM-DD format (optional)')
+    parser.add_argument('--data-type', default='trading', help='Data type to replay (default: trading)')
+    parser.add_argument('--columns', help='Comma-separated columns to output (default: all; timestamp and symbol are always included)')
+    parser.add_argument('--output-dir', default='./data', help='Directory the data was downloaded to (default: ./data)')
+    parser.add_argument('--output', help='Write the CSV to this file instead of standard output')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_ROWS, help=f'Rows read per symbol at a time (default: {DEFAULT_BATCH_ROWS})')
+    args = parser.parse_args(argv)
+
+    symbols = [coin.strip().upper() for coin in args.coins.split(',')]
+    columns = None
+    if args.columns:
+        requested = [name.strip() for name in args.columns.split(',')]
+        timestamp_column = get_timestamp_column(args.data_type)
+        columns = [timestamp_column, SYMBOL_COLUMN] + [name for name in requested if name not in (timestamp_column, SYMBOL_COLUMN)]
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        batches = replay(args.data_type, symbols, args.start_date, args.end_date, columns, args.batch_size, args.output_dir)
+        rows = write_csv(batches, output, columns)
+    except (ValueError, KeyError, ImportError) as e:
+        logging.error(str(e))
+        sys.exit(1)
+    except BrokenPipeError:
+        # The reader of standard output stopped early (e.g. `| head`); silence the flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    finally:
+        if args.output:
+            output.close()
+    logging.info(f"--- Replayed {rows} rows of {', '.join(symbols)} ---")
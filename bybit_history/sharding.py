@@ -0,0 +1,32 @@
+"""
+Deterministic partitioning of the download work across processes or machines (--shard i/N).
+
+A file belongs to shard crc32("<data_type>|<symbol>|<date>") % N, so every instance computes the
+same split without coordinating, and a file keeps its shard when other files are added.
+"""
+
+import zlib
+import argparse
+
+def parse_shard(value):
+    """Parses 'i/N' (1 <= i <= N) into a (index, count) tuple with a 0-based index; for argparse."""
+    index, _, count = value.partition('/')
+    if not (index.isdigit() and count.isdigit()) or not 1 <= int(index) <= int(count):
+        raise argparse.ArgumentTypeError(f"Invalid shard: '{value}'. Use i/N with 1 <= i <= N, e.g. 1/4.")
+    return int(index) - 1, int(count)
+
+def format_shard(shard):
+    """Formats a (index, count) tuple back as 'i/N'."""
+    return f"{shard[0] + 1}/{shard[1]}"
+
+def shard_of(data_type, symbol, file_date, count):
+    """Returns the 0-based shard a file is assigned to. file_date is a date or an ISO date string."""
+    key = f"{data_type}|{symbol}|{file_date}".encode('utf-8')
+    return zlib.crc32(key) % count
+
+def in_shard(shard, data_type, symbol, file_date):
+    """True if the file belongs to shard (a (index, count) tuple); always True when shard is None."""
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(data_type, symbol, file_date, count) == index
@@ -0,0 +1,194 @@
+"""
+Direct-to-memory streaming: read remote files as typed batches without writing anything to disk.
+
+Files are found with the downloader's planner (same coin directories, date filtering and listing
+cache), then each .csv.gz is downloaded, gunzipped and parsed incrementally. Up to `prefetch`
+files are fetched at once by background threads, each holding at most a few parsed batches, so
+the network, decompression and parsing of the next files overlap with the caller's processing
+while memory stays bounded. Batches are delivered in plan order (oldest file first).
+"""
+
+import csv
+import queue
+import codecs
+import logging
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+from . import bybit_data_downloader as downloader
+from .columnar import get_timestamp_column, iter_typed_row_chunks
+from .optional import import_optional
+from .ratelimit import DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_RATE, RateController, check_response
+from .reader import DEFAULT_BATCH_ROWS, get_time_bounds, iter_chunk_batches, to_date
+
+# Files downloaded and parsed ahead of the one being consumed
+DEFAULT_PREFETCH = 2
+
+# Parsed batches a prefetching file may hold before its thread waits for the consumer
+QUEUED_BATCHES = 4
+
+# Marks the end of a file in its queue
+END_OF_FILE = object()
+
+def iter_lines(chunks):
+    """Splits decompressed byte chunks into text lines (decoded as UTF-8, line endings kept)."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for data in chunks:
+        lines = (pending + decoder.decode(data)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+def skip_rows(rows, count):
+    """Yields the header row, then rows after the first count data rows (to resume a retried file)."""
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+    if first_row[:1] and first_row[0][:1].isdigit():
+        # No header: the first row is data
+        rows = itertools.chain([first_row], rows)
+    else:
+        yield first_row
+    yield from itertools.islice((row for row in rows if row), count, None)
+
+class RemoteFile:
+    """Streams one DownloadJob into parsed batches, resuming after a failure without repeating rows.
+
+    Requests go through session and are admitted and retried by rate_controller.
+    """
+
+    def __init__(self, job, columns, start_ns, end_ns, batch_size, session, rate_controller):
+        self.job = job
+        self.columns = columns
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.batch_size = batch_size
+        self.session = session
+        self.rate_controller = rate_controller
+        self.rows_done = 0 # Data rows already parsed and handed on (including ones filtered out by time)
+
+    def read(self, deliver):
+        """One attempt: streams the file from the start, skipping rows_done rows, and calls deliver(batch).
+
+        deliver returns False to stop early. Returns False if stopped, True when the file is complete.
+        """
+        np = import_optional('numpy')
+        timestamp_column = get_timestamp_column(self.job.data_type)
+        timings = {}
+        with self.session.get(self.job.url, stream=True) as response:
+            check_response(response)
+            expected_size = downloader.get_expected_size(response)
+            chunks = downloader.iter_timed(downloader.iter_response_bytes(response), 'download')
+            try:
+                rows = skip_rows(csv.reader(iter_lines(downloader.iter_decompressed(chunks, timings))), self.rows_done)
+                for columns, chunk in iter_typed_row_chunks(rows, self.job.data_type, self.batch_size):
+                    for batch in iter_chunk_batches(np, [(columns, chunk)], self.columns, timestamp_column, self.start_ns, self.end_ns):
+                        if not deliver(batch):
+                            return False
+                    self.rows_done += len(chunk[columns[0][0]])
+            finally:
+                metrics.observe('decompress', timings.get('decompress', 0.0))
+                metrics.add('bytes_in_total', timings.get('in', 0), stage='decompress')
+            if expected_size is not None and timings['in'] != expected_size:
+                raise downloader.IncompleteDownloadError(f"Received {timings['in']} of {expected_size} bytes for {self.job.url}")
+        return True
+
+    def run(self, output, stopped):
+        """Thread body: puts batches, then END_OF_FILE (or the exception that ended the file) into output."""
+        def deliver(batch):
+            while not stopped.is_set():
+                try:
+                    output.put(batch, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        try:
+            complete = self.rate_controller.call(
+                self.job.url, lambda: self.read(deliver), 'download',
+                retry_on=(downloader.IncompleteDownloadError, EOFError))
+            if complete:
+                metrics.add('files_total', result='streamed')
+            item = END_OF_FILE
+        except Exception as e:
+            metrics.add('files_total', result='failed')
+            item = e
+        while not stopped.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+def stream_batches(data_type, symbols, start, end=None, columns=None, batch_size=DEFAULT_BATCH_ROWS,
+                   base_url=downloader.DEFAULT_BASE_URL, prefetch=DEFAULT_PREFETCH, max_rate=DEFAULT_MAX_RATE,
+                   max_attempts=DEFAULT_MAX_ATTEMPTS, crawl_workers=downloader.DEFAULT_CRAWL_WORKERS, jobs=None):
+    """Lazily yields (job, batch) for remote files of data_type, streamed straight from the server.
+
+    symbols is a symbol, a list of symbols or 'ALL'; start/end/columns/batch_size are as for
+    reader.read() (rows outside a datetime range are dropped). job is the DownloadJob the batch
+    came from (data_type, symbol, date, url...), and batch a dict of column name -> numpy array, at
+    most batch_size rows, never mixing files. Files are planned by crawling base_url, or taken from
+    jobs (e.g. planner.load_plan()). prefetch files are fetched ahead in background threads.
+
+    A file that still fails after max_attempts raises its error here; batches already yielded from
+    it are not repeated by the retries. Nothing is written to disk. Each call plans and fetches
+    with a Session and RateController of its own, never the downloader's shared ones.
+    """
+    if prefetch < 1:
+        raise ValueError(f"prefetch must be at least 1, got {prefetch}")
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    start_ns, end_ns = get_time_bounds(start, end)
+    end_date = to_date(end).isoformat() if end is not None else None
+    rate_controller = RateController(max_rate, prefetch, max_attempts)
+    if jobs is None:
+        coins = ['ALL'] if [symbol.upper() for symbol in symbols] == ['ALL'] else symbols
+        jobs = downloader.plan_downloads([data_type], coins, to_date(start).isoformat(), end_date, base_url, crawl_workers,
+                                         max_rate=max_rate, max_attempts=max_attempts)
+    logging.info(f"Streaming {len(jobs)} files, {prefetch} at a time")
+
+    stopped = threading.Event()
+    pending = deque()
+    remaining = iter(jobs)
+    with downloader.create_session(prefetch) as session, ThreadPoolExecutor(max_workers=prefetch) as executor:
+        def submit():
+            job = next(remaining, None)
+            if job is not None:
+                output = queue.Queue(maxsize=QUEUED_BATCHES)
+                executor.submit(RemoteFile(job, columns, start_ns, end_ns, batch_size, session, rate_controller).run, output, stopped)
+                pending.append((job, output))
+
+        try:
+            for _ in range(prefetch):
+                submit()
+            while pending:
+                job, output = pending.popleft()
+                while True:
+                    item = output.get()
+                    if item is END_OF_FILE:
+                        break
+                    if isinstance(item, Exception):
+                        logging.error(f"Error streaming {job.url}: {item}")
+                        raise item
+                    yield job, item
+                submit()
+        finally:
+            # Also reached when the caller stops iterating: let the prefetching threads exit
+            stopped.set()
+
+def stream_to(callback, data_type, symbols, start, end=None, **options):
+    """Calls callback(job, batch) for every batch of stream_batches(); returns the number of rows streamed."""
+    rows = 0
+    for job, batch in stream_batches(data_type, symbols, start, end, **options):
+        callback(job, batch)
+        rows += len(next(iter(batch.values()))) if batch else 0
+    return rows
@@ -0,0 +1,220 @@
+"""
+Time index for plain CSV files: a sidecar of byte offsets and timestamps, so a sub-day range can be
+read by seeking to it instead of parsing the file from the start.
+
+The index is built while the downloader writes the extracted file (TimeIndexWriter is the sink
+extraction writes to), from the bytes passing through, so indexing needs no extra read. It is
+stored next to the file as <file>.idx, JSON like the blocked format's index:
+{"header": <first line>, "timestamp_column": <name or null>, "data_offset": <offset of row 0>,
+"rows": <data rows>, "size": <bytes>, "sorted": <bool>, "every_rows": N, "every_seconds": M,
+"entries": [[offset, row, timestamp_ns], ...]}. A reader ignores an index whose size no longer
+matches the file.
+An entry is added for the first data row, then at the first sampled line after N rows or M seconds
+since the previous entry. Lines are sampled about every SAMPLE_BYTES, which keeps indexing cheap
+(one parsed timestamp per sample instead of per row) and bounds the gap between entries.
+"""
+
+import os
+import csv
+import json
+import bisect
+
+from .blockgz import get_index_path, get_timestamp_parser
+
+# Default spacing of index entries
+DEFAULT_INDEX_ROWS = 100000
+DEFAULT_INDEX_SECONDS = 60
+
+# Bytes between the lines whose timestamp is checked while indexing
+SAMPLE_BYTES = 64 * 1024
+
+class TimeIndexBuilder:
+    """Builds the time index of a CSV file from its bytes, fed in order in chunks of any size."""
+
+    def __init__(self, data_type, every_rows=DEFAULT_INDEX_ROWS, every_seconds=DEFAULT_INDEX_SECONDS):
+        self.data_type = data_type
+        self.every_rows = every_rows
+        self.every_seconds = every_seconds
+        self.header = None
+        self.data_offset = 0
+        self.timestamp_column = None
+        self.timestamp_position = None
+        self.timestamp_converter = None
+        self.pending = b'' # Incomplete last line of the data fed so far
+        self.offset = 0 # File offset of pending
+        self.rows = 0 # Data rows before self.offset
+        self.next_sample = 0
+        self.sorted = True
+        self.last_timestamp = None
+        self.entries = []
+
+    def feed(self, data):
+        buffer = self.pending + data if self.pending else data
+        end = buffer.rfind(b'\n') + 1
+        if end == 0:
+            self.pending = buffer
+            return
+        position = 0
+        if self.header is None:
+            position = self.read_header(buffer[:end].split(b'\n', 1)[0])
+        while self.timestamp_converter is not None:
+            if self.offset + position < self.next_sample:
+                newline = buffer.find(b'\n', self.next_sample - self.offset - 1, end)
+                if newline < 0:
+                    break
+                self.rows += buffer.count(b'\n', position, newline + 1)
+                position = newline + 1
+            line_end = buffer.find(b'\n', position, end)
+            if line_end < 0:
+                break
+            self.sample(buffer[position:line_end], self.offset + position)
+            self.next_sample = self.offset + position + SAMPLE_BYTES
+        self.rows += buffer.count(b'\n', position, end)
+        self.pending = buffer[end:]
+        self.offset += end
+
+    def read_header(self, first_line):
+        """Handles the first line of the file; returns the offset of the first data row."""
+        text = first_line.decode('utf-8', 'replace').rstrip('\r')
+        if text[:1].isdigit():
+            self.header = ''
+            return 0
+        self.header = text
+        fields = text.split(',')
+        self.timestamp_position, self.timestamp_converter = get_timestamp_parser(self.data_type, fields)
+        if self.timestamp_position is not None:
+            self.timestamp_column = fields[self.timestamp_position]
+        self.data_offset = self.next_sample = len(first_line) + 1
+        return self.data_offset
+
+    def sample(self, line, offset):
+        """Checks the timestamp of the line at offset (the start of data row self.rows) and adds an entry if due."""
+        try:
+            timestamp = self.timestamp_converter([line.decode('utf-8').split(',')[self.timestamp_position]])[0]
+        except (IndexError, ValueError, UnicodeDecodeError):
+            return
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            self.sorted = False
+        self.last_timestamp = timestamp
+        if self.entries:
+            _, last_row, last_timestamp = self.entries[-1]
+            if self.rows - last_row < self.every_rows and timestamp - last_timestamp < self.every_seconds * 1000000000:
+                return
+        self.entries.append([offset, self.rows, timestamp])
+
+    def get_index(self):
+        """Returns the index of the data fed so far, as stored in the sidecar."""
+        rows = self.rows
+        if self.pending.strip():
+            # Last line without a trailing newline: a data row, unless it is the header of a one-line file
+            if self.header is not None or self.read_header(self.pending) == 0:
+                rows += 1
+        return {
+            'header': self.header or '',
+            'timestamp_column': self.timestamp_column,
+            'data_offset': self.data_offset,
+            'rows': rows,
+            'size': self.offset + len(self.pending),
+            'sorted': self.sorted,
+            'every_rows': self.every_rows,
+            'every_seconds': self.every_seconds,
+            'entries': self.entries,
+        }
+
+class TimeIndexWriter:
+    """File-like sink that writes a CSV byte stream to path unchanged and its time index to index_path on close()."""
+
+    def __init__(self, path, index_path, data_type, every_rows=DEFAULT_INDEX_ROWS, every_seconds=DEFAULT_INDEX_SECONDS):
+        self.file = open(path, 'wb')
+        self.index_path = index_path
+        self.builder = TimeIndexBuilder(data_type, every_rows, every_seconds)
+
+    def write(self, data):
+        self.builder.feed(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        write_index(self.index_path, self.builder.get_index())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+def write_index(index_path, index):
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+def index_file(path, data_type, every_rows=DEFAULT_INDEX_ROWS, every_seconds=DEFAULT_INDEX_SECONDS):
+    """Builds the time index of an existing CSV file (e.g. one downloaded before indexing existed). Returns it."""
+    builder = TimeIndexBuilder(data_type, every_rows, every_seconds)
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            builder.feed(data)
+    index = builder.get_index()
+    write_index(get_index_path(path), index)
+    return index
+
+def read_time_index(path):
+    """Loads the time index of a CSV file, or returns None if it has none or it no longer matches the file."""
+    try:
+        with open(get_index_path(path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if 'entries' not in index or index.get('size') != os.path.getsize(path):
+        return None
+    return index
+
+def find_byte_range(index, start_ns=None, end_ns=None):
+    """Returns (start_offset, end_offset) of the lines that can hold rows with start_ns <= timestamp <= end_ns.
+
+    end_offset is None for the end of the file. Without a usable index (unsorted rows, no timestamp
+    column or no entries) the range is the whole file after the header.
+    """
+    entries = index['entries']
+    data_start = index['data_offset']
+    if not index.get('sorted') or not entries:
+        return data_start, None
+    timestamps = [entry[2] for entry in entries]
+    start_offset = data_start
+    if start_ns is not None:
+        # The last entry before start_ns: rows from there on may be in range
+        position = bisect.bisect_left(timestamps, start_ns)
+        if position > 0:
+            start_offset = entries[position - 1][0]
+    end_offset = None
+    if end_ns is not None:
+        # The first entry after end_ns: every row from there on is out of range
+        position = bisect.bisect_right(timestamps, end_ns)
+        if position < len(entries):
+            end_offset = entries[position][0]
+    return start_offset, max(end_offset, start_offset) if end_offset is not None else None
+
+def iter_range_rows(path, start_ns=None, end_ns=None, index=None):
+    """Yields CSV rows (lists of str, the header first if the file has one) from the part of path that can be in range.
+
+    Seeks straight to the range found in the time index and stops reading at its end; rows near
+    both ends may still be outside [start_ns, end_ns] and need filtering.
+    """
+    index = index or read_time_index(path)
+    start_offset, end_offset = find_byte_range(index, start_ns, end_ns)
+
+    def lines(f):
+        position = start_offset
+        for line in f:
+            if end_offset is not None and position >= end_offset:
+                return
+            position += len(line)
+            yield line.decode('utf-8')
+
+    if index['header']:
+        yield next(csv.reader([index['header']]))
+    with open(path, 'rb') as f:
+        f.seek(start_offset)
+        yield from csv.reader(lines(f))
@@ -0,0 +1,99 @@
+import time
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from bybit_history import ratelimit
+from bybit_history.ratelimit import BREAKER_THRESHOLD, CircuitOpenError, RateController
+
+URL = 'http://example.test/file.csv.gz'
+
+class FlakyHost:
+    """Operation that raises a connection error while down, and counts the calls that reach it."""
+
+    def __init__(self):
+        self.down = True
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            if self.down:
+                raise requests.exceptions.ConnectionError('connection refused')
+            return 'ok'
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(ratelimit, 'BREAKER_COOLDOWN', 0.3),
+            mock.patch.object(ratelimit, 'BACKOFF_BASE', 0.001),
+            mock.patch.object(ratelimit, 'BREAKER_MAX_PROBES', 2),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.controller = RateController(max_rate=0, max_window=4, max_attempts=BREAKER_THRESHOLD)
+        self.host = FlakyHost()
+
+    def trip(self):
+        """Fails max_attempts requests in a row, which opens the circuit."""
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.controller.call(URL, self.host, 'download')
+        state = self.controller.get_host('example.test')
+        self.assertGreaterEqual(state.failures, BREAKER_THRESHOLD)
+        self.assertGreater(state.open_until, time.monotonic())
+
+    def test_requests_wait_for_cooldown_and_recover(self):
+        self.trip()
+        self.host.down = False
+        calls = self.host.calls
+        started = time.monotonic()
+        self.assertEqual(self.controller.call(URL, self.host, 'download'), 'ok')
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        # Nothing is sent while the circuit is open: the first request after the cooldown is the probe
+        self.assertEqual(self.host.calls, calls + 1)
+        self.assertEqual(self.controller.get_host('example.test').failures, 0)
+
+    def test_others_wait_for_the_probe(self):
+        self.trip()
+        self.host.down = False
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.controller.call(URL, self.host, 'download')))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ['ok'] * 4)
+
+    def test_failed_probe_reopens_then_recovers(self):
+        self.trip()
+        state = self.controller.get_host('example.test')
+        # The probe fails: the circuit opens again, and the waiting call's next attempt waits once more
+        host = self.host
+        outcomes = iter([True, False])
+
+        def operation():
+            host.down = next(outcomes, False)
+            return host()
+
+        self.assertEqual(self.controller.call(URL, operation, 'download'), 'ok')
+        self.assertEqual(state.failures, 0)
+        self.assertEqual(state.failed_probes, 0)
+
+    def test_fails_fast_once_probes_keep_failing(self):
+        self.trip()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.controller.call(URL, self.host, 'download')
+        state = self.controller.get_host('example.test')
+        self.assertGreaterEqual(state.failed_probes, ratelimit.BREAKER_MAX_PROBES)
+        calls = self.host.calls
+        with self.assertRaises(CircuitOpenError):
+            self.controller.call(URL, self.host, 'download')
+        self.assertEqual(self.host.calls, calls)
+
+if __name__ == '__main__':
+    unittest.main()